@@ -0,0 +1,417 @@
+""" Benchmarks of crypto, parsing, network and receive paths of the Clipster client
+
+Runs offline against the in-memory stub server, with config, cache and
+outbox in a temporary directory. Latency and throughput are measured over
+several runs, memory peaks in one additional run with tracemalloc. Results
+are stored as JSON and can be compared with the results of another version:
+
+    python benchmarks/bench_clipster.py --label old
+    python benchmarks/bench_clipster.py --label new --compare old
+"""
+import gc
+import sys
+import json
+import time
+import queue
+import random
+import string
+import logging
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+import tracemalloc
+from pathlib import Path
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+from clipster.config import Config  # noqa: E402
+from clipster.log_config import log  # noqa: E402
+from clipster.crypt import Crypt  # noqa: E402
+from clipster.api import Api  # noqa: E402
+from clipster.worker import Worker  # noqa: E402
+from clipster.receiver import ClipReceiver  # noqa: E402
+from stub_server import StubServer  # noqa: E402
+
+RESULTS_DIR = BENCH_DIR / "results"
+USER = "bench"
+PASSWORD = "benchmark-password"
+CLIP_SIZES = (100, 10 * 1024, 1024 * 1024)
+HISTORY_LENGTHS = (10, 100, 1000)
+HISTORY_CLIP_SIZE = 200
+SLOWER_THRESHOLD = 1.1
+RECEIVE_TIMEOUT = 1
+
+
+def random_text(size):
+    """ Return random printable text, which compresses like typical clips
+    """
+    words = [
+        "".join(random.choices(string.ascii_lowercase, k=random.randint(2, 10)))
+        for _ in range(200)
+    ]
+    text = ""
+    while len(text) < size:
+        text += " ".join(random.choices(words, k=100)) + "\n"
+    return text[:size]
+
+
+def encrypt_text(crypto, size):
+    """ Return random text of size encrypted as the server stores it
+    """
+    return crypto.encrypt(random_text(size)).decode()
+
+
+def measure(name, fn, repeat, size=None, setup=None, **params):
+    """ Run fn repeat times and once more with tracemalloc for its memory peak
+
+    Args:
+        name (str): Name of benchmark
+        fn (callable): Function to measure
+        repeat (int): Number of timed runs
+        size (int): Bytes processed per run, to report throughput
+        setup (callable): Called untimed before every run
+        params: Parameters of benchmark, part of its identity
+
+    Returns:
+        dict: Result of benchmark
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    if setup:
+        setup()
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    timings.sort()
+    median = statistics.median(timings)
+    result = {
+        "name": name,
+        "params": params,
+        "repeat": repeat,
+        "min_ms": timings[0] * 1000,
+        "median_ms": median * 1000,
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1000,
+        "peak_kb": peak / 1024,
+    }
+    if size:
+        result["mb_per_s"] = size / median / 1e6
+    print_result(result)
+    return result
+
+
+def print_result(result):
+    params = ", ".join(f"{key}={value}" for key, value in result["params"].items())
+    throughput = result.get("mb_per_s")
+    print(
+        f"{result['name'] + ' ' + params:<45} "
+        f"{result['median_ms']:10.2f} ms "
+        f"{result['p95_ms']:10.2f} ms p95 "
+        f"{result['peak_kb']:10.0f} KB peak"
+        + (f" {throughput:8.1f} MB/s" if throughput else "")
+    )
+
+
+def use_temp_config_dir(path):
+    """ Keep cursor, cache, outbox and socket of benchmarks out of the
+        config dir of the user
+    """
+    Config.PATH_CONFIG_DIR = path
+    Config.PATH_CONFIG_FILE = path / "config"
+    Config.PATH_CURSOR_FILE = path / "cursor"
+    Config.PATH_CACHE_FILE = path / "cache.db"
+    Config.PATH_OUTBOX_FILE = path / "outbox.db"
+    Config.PATH_IPC_SOCKET = path / "clipster.sock"
+
+
+def bench_crypto(args, keys):
+    results = []
+    salt = f"clipster_{USER}_{PASSWORD}".encode()
+    for iterations in (Crypt.HASH_ITERS_LOGIN, Crypt.HASH_ITERS_MSG):
+        results.append(
+            measure(
+                "crypt.get_hash",
+                lambda: Crypt.get_hash(PASSWORD.encode(), salt, iterations),
+                max(1, args.repeat // 4),
+                iterations=iterations,
+            )
+        )
+    for compress in (False, True):
+        crypto = Crypt(USER, None, *keys, compress=compress)
+        for size in args.sizes:
+            text = random_text(size)
+            token = crypto.encrypt(text).decode()
+            results.append(
+                measure(
+                    "crypt.encrypt",
+                    lambda: crypto.encrypt(text),
+                    args.repeat,
+                    size=size,
+                    size_bytes=size,
+                    compress=compress,
+                )
+            )
+            results.append(
+                measure(
+                    "crypt.decrypt",
+                    lambda: crypto.decrypt(token),
+                    args.repeat,
+                    size=size,
+                    setup=crypto.memo_clear,
+                    size_bytes=size,
+                    compress=compress,
+                )
+            )
+    return results
+
+
+def bench_parse(args, api):
+    results = []
+    for length in args.lengths:
+        clips = [
+            {"id": index, "text": encrypt_text(api.crypto, HISTORY_CLIP_SIZE)}
+            for index in range(1, length + 1)
+        ]
+        response = SimpleNamespace(text=json.dumps(clips))
+        results.append(
+            measure(
+                "api.parse_and_decrypt_response",
+                lambda: api.parse_and_decrypt_response(response),
+                args.repeat,
+                size=len(response.text),
+                setup=api.crypto.memo_clear,
+                clips=length,
+            )
+        )
+    return results
+
+
+def bench_network(args, api, server):
+    results = []
+    counter = iter(range(sys.maxsize))
+    for size in args.sizes:
+        text = random_text(size)
+        results.append(
+            measure(
+                "api.upload",
+                lambda: api.upload(f"{next(counter)} {text}"),
+                args.repeat,
+                size=size,
+                size_bytes=size,
+            )
+        )
+
+    def reset_client():
+        api.cache.clear()
+        api.crypto.memo_clear()
+        api.validators.clear()
+        if Config.PATH_CURSOR_FILE.exists():
+            Config.PATH_CURSOR_FILE.unlink()
+
+    for length in args.lengths:
+        server.clear()
+        for _ in range(length):
+            clip = encrypt_text(api.crypto, HISTORY_CLIP_SIZE)
+            server.add_clip(USER, clip, "bench")
+        results.append(
+            measure(
+                "api.download cold",
+                lambda: api.download(paste=False),
+                args.repeat,
+                setup=reset_client,
+                clips=length,
+            )
+        )
+        results.append(
+            measure(
+                "api.download cached",
+                lambda: api.download(paste=False),
+                args.repeat,
+                clips=length,
+            )
+        )
+        results.append(
+            measure(
+                "api.download incremental",
+                lambda: api.download(incremental=True, paste=False),
+                args.repeat,
+                clips=length,
+            )
+        )
+    return results
+
+
+class RecordingApi(Api):
+    """ Api that records pasted clips instead of using the system clipboard
+    """
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.pasted = queue.Queue()
+
+    def paste(self, data):
+        self.pasted.put(data)
+
+    @staticmethod
+    def copy():
+        return None
+
+
+def bench_receive(args, api, keys):
+    """ Measure time from sharing a clip until the receiver of another
+        client pastes it. Fails if that takes longer than RECEIVE_TIMEOUT
+    """
+    receiving_api = RecordingApi(api.SERVER, USER, *keys)
+    # the receiver only pastes clips newer than the ones it has seen
+    api.upload("receive start")
+    receiving_api.download(paste=False)
+    receiver = ClipReceiver(receiving_api, Worker(1))
+    receiver.start()
+    counter = iter(range(sys.maxsize))
+
+    def share_and_receive():
+        text = f"receive {next(counter)}"
+        api.upload(text)
+        try:
+            pasted = receiving_api.pasted.get(timeout=RECEIVE_TIMEOUT)
+        except queue.Empty:
+            raise RuntimeError(f"Clip not received within {RECEIVE_TIMEOUT}s")
+        if pasted != text:
+            raise RuntimeError(f"Received {pasted!r} instead of {text!r}")
+
+    try:
+        # give the receiver time to open the event stream
+        time.sleep(0.5)
+        return [measure("receiver.event", share_and_receive, args.repeat)]
+    finally:
+        receiver.stop()
+        receiving_api.close()
+
+
+def get_label():
+    """ Return short git commit of the working tree, or local without git
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=str(BENCH_DIR),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "local"
+
+
+def get_results_path(name):
+    """ Results are given as path or as label of a file in RESULTS_DIR
+    """
+    path = Path(name)
+    if path.suffix == ".json" or path.exists():
+        return path
+    return RESULTS_DIR / f"{name}.json"
+
+
+def compare(results, baseline_path):
+    """ Print median latency of results relative to baseline results
+    """
+    baseline = json.loads(get_results_path(baseline_path).read_text())
+    old = {
+        (result["name"], json.dumps(result["params"], sort_keys=True)): result
+        for result in baseline["results"]
+    }
+    print(f"\nCompared with {baseline['meta']['label']}:")
+    for result in results:
+        key = (result["name"], json.dumps(result["params"], sort_keys=True))
+        if key not in old:
+            continue
+        ratio = result["median_ms"] / old[key]["median_ms"]
+        marker = "  SLOWER" if ratio > SLOWER_THRESHOLD else ""
+        params = ", ".join(f"{k}={v}" for k, v in result["params"].items())
+        print(f"{result['name'] + ' ' + params:<45} {ratio:6.2f}x{marker}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[1:]),
+    )
+    parser.add_argument(
+        "--only",
+        choices=("crypto", "parse", "network", "receive"),
+        action="append",
+        help="run only this group, may be given several times",
+    )
+    parser.add_argument("--repeat", type=int, default=20, help="timed runs")
+    parser.add_argument(
+        "--quick", action="store_true", help="skip largest clip size and history"
+    )
+    parser.add_argument("--label", help="name of results, default is git commit")
+    parser.add_argument(
+        "--compare", metavar="LABEL", help="compare with stored results"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of random clips")
+    args = parser.parse_args()
+    args.sizes = CLIP_SIZES[:-1] if args.quick else CLIP_SIZES
+    args.lengths = HISTORY_LENGTHS[:-1] if args.quick else HISTORY_LENGTHS
+    args.label = args.label or get_label()
+    return args
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    log.setLevel(logging.WARNING)
+    groups = args.only or ("crypto", "parse", "network", "receive")
+    results = []
+    with tempfile.TemporaryDirectory() as config_dir:
+        use_temp_config_dir(Path(config_dir))
+        server = StubServer()
+        server.start()
+        try:
+            Api.register(server.url, USER, PASSWORD)
+            keys = Crypt.derive_keys(USER, PASSWORD)
+            Config.SERVER, Config.USER = server.url, USER
+            api = Api(server.url, USER, *keys)
+            if "crypto" in groups:
+                results += bench_crypto(args, keys)
+            if "parse" in groups:
+                results += bench_parse(args, api)
+            if "network" in groups:
+                results += bench_network(args, api, server)
+            if "receive" in groups:
+                results += bench_receive(args, api, keys)
+            api.close()
+        finally:
+            server.stop()
+    meta = {
+        "label": args.label,
+        "date": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": args.repeat,
+        "seed": args.seed,
+    }
+    RESULTS_DIR.mkdir(exist_ok=True)
+    path = get_results_path(args.label)
+    path.write_text(json.dumps({"meta": meta, "results": results}, indent=2))
+    print(f"\nResults stored in {path}")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
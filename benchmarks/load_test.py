@@ -0,0 +1,283 @@
+""" Load generator driving many simulated Clipster clients concurrently
+
+Every client is an Api instance with its own account, cache and outbox that
+shares and downloads clips in a loop. By default the reference server is
+started in this process with the given latency, faults and history size;
+use --server to load another server. Client counts are run as stages, so
+the point where throughput stops scaling shows up in one run:
+
+    python benchmarks/load_test.py --clients 1,4,16,64 --latency 20
+    python benchmarks/load_test.py --clients 8 --error-rate 0.1 --drop-rate 0.02
+"""
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from pathlib import Path
+from collections import Counter, defaultdict
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent))
+
+from clipster.config import Config  # noqa: E402
+from clipster.log_config import log  # noqa: E402
+from clipster.crypt import Crypt  # noqa: E402
+from clipster.api import Api, RegisterException  # noqa: E402
+from stub_server import StubServer, add_server_arguments, get_server_options  # noqa
+
+PASSWORD = "load-test-password"
+REGISTER_ATTEMPTS = 20
+OPERATIONS = ("upload", "download", "receive")
+
+
+class Stats:
+    """ Latencies and errors of operations, collected from all clients
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+
+    def record(self, operation, seconds, error=None):
+        with self.lock:
+            if error is None:
+                self.latencies[operation].append(seconds)
+            else:
+                self.errors[(operation, type(error).__name__)] += 1
+
+    @staticmethod
+    def percentile(values, share):
+        return values[min(len(values) - 1, int(len(values) * share))]
+
+    def summary(self, duration):
+        """ Return throughput and latency percentiles per operation
+        """
+        summary = {}
+        for operation in OPERATIONS:
+            latencies = sorted(self.latencies.get(operation, []))
+            errors = {
+                error: count
+                for (op, error), count in self.errors.items()
+                if op == operation
+            }
+            if not latencies and not errors:
+                continue
+            entry = {"ok": len(latencies), "errors": errors}
+            entry["ops_per_s"] = len(latencies) / duration
+            if latencies:
+                for name, share in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+                    entry[f"{name}_ms"] = self.percentile(latencies, share) * 1000
+            summary[operation] = entry
+        return summary
+
+
+def register(server_url, user):
+    """ Register user, retrying failures injected by the server
+    """
+    for attempt in range(REGISTER_ATTEMPTS):
+        try:
+            return Api.register(server_url, user, PASSWORD)
+        except RegisterException:
+            if attempt == REGISTER_ATTEMPTS - 1:
+                raise
+            time.sleep(0.1)
+
+
+def create_clients(count, server_url, client_dir, separate_sessions):
+    """ Register users and create an Api for each simulated client. Cache
+        and outbox paths are read from Config when an Api is created, so
+        clients are created one after the other, each with its own paths
+    """
+    clients = []
+    for _ in range(count):
+        user = f"load-{uuid.uuid4().hex[:12]}"
+        register(server_url, user)
+        keys = Crypt.derive_keys(user, PASSWORD)
+        path = client_dir / user
+        Config.PATH_CACHE_FILE = path / "cache.db"
+        Config.PATH_OUTBOX_FILE = path / "outbox.db"
+        api_class = Api
+        if separate_sessions:
+            api_class = type("ClientApi", (Api,), {"session": None})
+        clients.append(api_class(server_url, user, *keys))
+    return clients
+
+
+def run_client(api, args, stats, deadline, seed):
+    """ Share or download clips until deadline, the operation is chosen at
+        random with the configured mix. Incremental fetches keep a cursor
+        per client, as the cursor file of Config is shared by all of them
+    """
+    rng = random.Random(seed)
+    counter = 0
+    cursor = None
+    while time.monotonic() < deadline:
+        choice = rng.random()
+        if choice < args.upload_share:
+            operation = "upload"
+        elif choice < args.upload_share + args.receive_share:
+            operation = "receive"
+        else:
+            operation = "download"
+        start = time.perf_counter()
+        try:
+            if operation == "upload":
+                counter += 1
+                api.upload(f"{api.USER} {counter} " + "x" * args.size)
+            elif operation == "receive":
+                clips = api.fetch_new_clips(cursor)
+                api.decrypt_clips(clips)
+                cursor = clips[-1] if clips else cursor
+            else:
+                api.download(paste=False)
+        except Exception as e:
+            stats.record(operation, time.perf_counter() - start, e)
+        else:
+            stats.record(operation, time.perf_counter() - start)
+        if args.think_time:
+            time.sleep(args.think_time / 1000)
+
+
+def run_stage(count, args, server_url, client_dir):
+    """ Run count clients concurrently for the configured duration
+
+    Returns:
+        dict: Summary of stage
+    """
+    clients = create_clients(count, server_url, client_dir, args.separate_sessions)
+    for api in clients:
+        if api.outbox and not args.outbox:
+            api.outbox.close()
+            api.outbox = None
+    stats = Stats()
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(
+            target=run_client, args=(api, args, stats, deadline, args.seed + index)
+        )
+        for index, api in enumerate(clients)
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - started
+    for api in clients:
+        api.close()
+    summary = stats.summary(duration)
+    total = sum(entry["ok"] for entry in summary.values())
+    return {
+        "clients": count,
+        "duration_s": duration,
+        "ops_per_s": total / duration,
+        "operations": summary,
+    }
+
+
+def print_stage(stage):
+    print(
+        f"\n{stage['clients']} clients: {stage['ops_per_s']:.1f} ops/s "
+        f"in {stage['duration_s']:.1f}s"
+    )
+    for operation, entry in stage["operations"].items():
+        latencies = " ".join(
+            f"{name} {entry[f'{name}_ms']:8.1f} ms"
+            for name in ("p50", "p95", "p99")
+            if f"{name}_ms" in entry
+        )
+        print(
+            f"  {operation:<9} {entry['ok']:7d} ok {entry['ops_per_s']:8.1f}/s "
+            f"{latencies}"
+        )
+        for error, count in sorted(entry["errors"].items()):
+            print(f"  {'':<9} {count:7d} {error}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=__doc__.splitlines()[0],
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="\n".join(__doc__.splitlines()[1:]),
+    )
+    parser.add_argument(
+        "--clients",
+        default="1,4,16",
+        help="comma separated numbers of concurrent clients, one stage each",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10, help="seconds per stage"
+    )
+    parser.add_argument("--size", type=int, default=1000, help="clip size")
+    parser.add_argument(
+        "--upload-share", type=float, default=0.3, help="share of uploads"
+    )
+    parser.add_argument(
+        "--receive-share",
+        type=float,
+        default=0.5,
+        help="share of incremental fetches, the rest are full downloads",
+    )
+    parser.add_argument(
+        "--think-time", type=float, default=0, metavar="MS", help="pause per client"
+    )
+    parser.add_argument(
+        "--separate-sessions",
+        action="store_true",
+        help="give every client its own connection pool like separate processes",
+    )
+    parser.add_argument(
+        "--outbox", action="store_true", help="queue failed uploads in outboxes"
+    )
+    parser.add_argument("--server", help="URL of server to load instead")
+    parser.add_argument("--output", help="store results as JSON")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--verbose", action="store_true", help="show client log")
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    args.client_counts = [int(count) for count in args.clients.split(",")]
+    return args
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    log.setLevel(logging.DEBUG if args.verbose else logging.CRITICAL)
+    server = None
+    server_url = args.server
+    if not server_url:
+        server = StubServer(**get_server_options(args))
+        server.start()
+        server_url = server.url
+    stages = []
+    try:
+        with tempfile.TemporaryDirectory() as client_dir:
+            Config.PATH_CURSOR_FILE = Path(client_dir) / "cursor"
+            for count in args.client_counts:
+                stage = run_stage(count, args, server_url, Path(client_dir))
+                print_stage(stage)
+                stages.append(stage)
+    finally:
+        if server:
+            server.stop()
+    if server:
+        print("\nServer responses:")
+        for (method, route, status), count in sorted(
+            server.requests.items(), key=lambda item: str(item[0])
+        ):
+            print(f"  {method:<5} {route:<16} {status!s:<8} {count:7d}")
+    if args.output:
+        Path(args.output).write_text(
+            json.dumps({"options": vars(args), "stages": stages}, indent=2)
+        )
+        print(f"\nResults stored in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+""" In-memory reference Clipster server for benchmarks, load and integration tests
+
+Implements the endpoints used by the desktop client: /register/,
+/verify-user/, /copy-paste/ with incremental sync, long polling and
+conditional requests, the event stream, chunked and batch uploads. Latency,
+errors and dropped connections can be injected and the history size per
+user can be limited. Clips are kept in memory and lost on exit.
+
+Usage:
+    python benchmarks/stub_server.py --port 8000 --latency 50 --error-rate 0.05
+"""
+import re
+import json
+import time
+import base64
+import random
+import argparse
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+MAX_WAIT = 60
+EVENTS_KEEPALIVE = 15
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """ Answer client requests from the state of the StubServer
+    """
+
+    protocol_version = "HTTP/1.1"
+    # headers and body are written separately, with Nagle's algorithm every
+    # keep-alive response would wait for the delayed ACK of the client
+    disable_nagle_algorithm = True
+    ROUTES = [
+        ("GET", r"/verify-user/", "verify_user"),
+        ("POST", r"/register/", "register"),
+        ("GET", r"/copy-paste/", "list_clips"),
+        ("POST", r"/copy-paste/", "add_clip"),
+        ("GET", r"/copy-paste/events/", "events"),
+        ("POST", r"/copy-paste/batch/", "add_batch"),
+        ("POST", r"/copy-paste/upload/", "start_upload"),
+        ("GET", r"/copy-paste/upload/(\d+)/", "get_upload"),
+        ("PUT", r"/copy-paste/upload/(\d+)/(\d+)/", "add_segment"),
+        ("POST", r"/copy-paste/upload/(\d+)/complete/", "complete_upload"),
+    ]
+    route = "unknown"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def send_response(self, code, message=None):
+        self.server.count_request(self.command, self.route, code)
+        super().send_response(code, message)
+
+    def send_json(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def read_form(self):
+        body = self.read_body().decode()
+        return {key: values[0] for key, values in parse_qs(body).items()}
+
+    def get_user(self):
+        """ Return user of valid basic auth header or None
+        """
+        auth = self.headers.get("Authorization", "")
+        if not auth.startswith("Basic "):
+            return None
+        try:
+            user, password = base64.b64decode(auth[6:]).decode().split(":", 1)
+        except ValueError:
+            return None
+        if self.server.users.get(user) != password:
+            return None
+        return user
+
+    def do_HEAD(self):
+        self.route = "head"
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def do_PUT(self):
+        self.dispatch()
+
+    def dispatch(self):
+        """ Inject faults, then call handler of matching route
+        """
+        url = urlsplit(self.path)
+        self.query = parse_qs(url.query)
+        for method, pattern, name in self.ROUTES:
+            match = re.fullmatch(pattern, url.path)
+            if match and method == self.command:
+                self.route = name
+                break
+        else:
+            self.read_body()
+            self.send_json(404, {"detail": "Not found"})
+            return
+        if not self.inject_faults():
+            return
+        if name != "register":
+            self.user = self.get_user()
+            if not self.user:
+                self.read_body()
+                self.send_json(401, {"detail": "Invalid username/password."})
+                return
+        getattr(self, name)(*match.groups())
+
+    def inject_faults(self):
+        """ Delay request and answer it with an error or drop the connection
+            as configured
+
+        Returns:
+            bool: Whether request should be handled
+        """
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay:
+            time.sleep(delay)
+        if random.random() < server.drop_rate:
+            server.count_request(self.command, self.route, "dropped")
+            self.close_connection = True
+            return False
+        if random.random() < server.error_rate:
+            self.read_body()
+            self.send_json(server.error_status, {"detail": "Injected error"})
+            return False
+        return True
+
+    def register(self):
+        form = self.read_form()
+        if not form.get("username") or not form.get("password"):
+            self.send_json(400, {"detail": "username and password required"})
+            return
+        with self.server.lock:
+            exists = form["username"] in self.server.users
+            if not exists:
+                self.server.users[form["username"]] = form["password"]
+        if exists:
+            self.send_json(400, {"username": ["User already exists"]})
+            return
+        self.send_json(201, {"username": form["username"]})
+
+    def verify_user(self):
+        self.send_json(200, {"detail": "Login successful"})
+
+    def list_clips(self):
+        """ Return clips, newer than since_id only if given. With wait, the
+            request is held until there are any. Supports If-None-Match
+        """
+        since_id = self.query.get("since_id", [None])[0]
+        wait = min(float(self.query.get("wait", [0])[0]), MAX_WAIT)
+        if since_id is not None and not since_id.isdigit():
+            self.send_json(400, {"detail": "since_id must be a clip id"})
+            return
+        since_id = int(since_id or 0)
+        if not since_id:
+            wait = 0
+        clips = self.server.wait_for_clips(self.user, since_id, wait)
+        etag = f'"{self.server.get_last_id(self.user)}-{len(clips)}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_json(304, headers={"ETag": etag})
+            return
+        self.send_json(200, clips, headers={"ETag": etag})
+
+    def add_clip(self):
+        form = self.read_form()
+        if not form.get("text"):
+            self.send_json(400, {"text": ["This field is required."]})
+            return
+        clip = self.server.add_clip(self.user, form["text"], form.get("device"))
+        self.send_json(201, clip)
+
+    def add_batch(self):
+        """ Store several clips. Answers 207 with the status of every clip
+            if some are invalid
+        """
+        try:
+            body = json.loads(self.read_body())
+            clips = body["clips"]
+        except (ValueError, KeyError, TypeError):
+            self.send_json(400, {"detail": "Invalid batch"})
+            return
+        results = []
+        for clip in clips:
+            if not isinstance(clip, dict) or not clip.get("text"):
+                results.append({"status": 400, "error": "text is required"})
+                continue
+            self.server.add_clip(self.user, clip["text"], body.get("device"))
+            results.append({"status": 201})
+        failed = any(result["status"] != 201 for result in results)
+        self.send_json(207 if failed else 201, {"results": results})
+
+    def events(self):
+        """ Stream an event for every new clip until the client disconnects
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        last_id = self.server.get_last_id(self.user)
+        try:
+            while not self.server.stopping:
+                clips = self.server.wait_for_clips(
+                    self.user, last_id, EVENTS_KEEPALIVE
+                )
+                if clips:
+                    last_id = clips[-1]["id"]
+                    message = f"id: {last_id}\ndata: {json.dumps({'id': last_id})}"
+                else:
+                    message = ": keepalive"
+                self.wfile.write(f"{message}\n\n".encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def start_upload(self):
+        form = self.read_form()
+        try:
+            chunks = int(form["chunks"])
+        except (KeyError, ValueError):
+            self.send_json(400, {"chunks": ["A valid integer is required."]})
+            return
+        upload_id = self.server.start_upload(self.user, form.get("device"), chunks)
+        self.send_json(201, {"id": upload_id})
+
+    def get_upload(self, upload_id):
+        upload = self.server.get_upload(self.user, int(upload_id))
+        if upload is None:
+            self.send_json(404, {"detail": "Not found"})
+            return
+        self.send_json(200, {"received": sorted(upload["segments"])})
+
+    def add_segment(self, upload_id, index):
+        form = self.read_form()
+        upload = self.server.get_upload(self.user, int(upload_id))
+        if upload is None:
+            self.send_json(404, {"detail": "Not found"})
+            return
+        if int(index) >= upload["chunks"] or not form.get("text"):
+            self.send_json(400, {"detail": "Invalid chunk"})
+            return
+        with self.server.lock:
+            upload["segments"][int(index)] = form["text"]
+        self.send_json(200, {"received": int(index)})
+
+    def complete_upload(self, upload_id):
+        self.read_body()
+        clip = self.server.complete_upload(self.user, int(upload_id))
+        if clip is None:
+            self.send_json(400, {"detail": "Upload is incomplete"})
+            return
+        self.send_json(201, clip)
+
+
+class StubServer(ThreadingHTTPServer):
+    """ Threaded HTTP server keeping users and clips in memory
+
+    Args:
+        latency (float): Seconds every request is delayed
+        jitter (float): Maximum additional random delay in seconds
+        error_rate (float): Share of requests answered with error_status
+        error_status (int): HTTP status of injected errors
+        drop_rate (float): Share of requests whose connection is closed
+            without answer
+        history (int): Clips kept per user, 0 keeps all
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency=0,
+        jitter=0,
+        error_rate=0,
+        error_status=503,
+        drop_rate=0,
+        history=0,
+        verbose=False,
+    ):
+        super().__init__((host, port), StubHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.history = history
+        self.verbose = verbose
+        self.stopping = False
+        self.users = {}
+        self.clips = {}
+        self.uploads = {}
+        self.last_id = 0
+        self.last_upload_id = 0
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.clips_added = threading.Condition(self.lock)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count_request(self, method, route, status):
+        with self.lock:
+            self.requests[(method, route, status)] += 1
+
+    def add_clip(self, user, text, device):
+        """ Store clip, drop the oldest ones exceeding history and notify
+            waiting requests
+        """
+        with self.lock:
+            self.last_id += 1
+            clip = {
+                "id": self.last_id,
+                "user": user,
+                "text": text,
+                "device": device,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+            }
+            clips = self.clips.setdefault(user, [])
+            clips.append(clip)
+            if self.history and len(clips) > self.history:
+                del clips[: len(clips) - self.history]
+            self.clips_added.notify_all()
+        return clip
+
+    def get_last_id(self, user):
+        with self.lock:
+            clips = self.clips.get(user)
+            return clips[-1]["id"] if clips else 0
+
+    def get_clips(self, user, since_id=0):
+        """ Return clips of user newer than since_id, all for 0. Must be
+            called holding the lock
+        """
+        clips = self.clips.get(user, [])
+        if not since_id:
+            return list(clips)
+        return [clip for clip in clips if clip["id"] > since_id]
+
+    def wait_for_clips(self, user, since_id=0, wait=0):
+        """ Return clips newer than since_id, all for 0, waiting up to wait
+            seconds until there are any
+        """
+        deadline = time.monotonic() + wait
+        with self.lock:
+            clips = self.get_clips(user, since_id)
+            while not clips and not self.stopping:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.clips_added.wait(remaining)
+                clips = self.get_clips(user, since_id)
+        return clips
+
+    def clear(self):
+        """ Remove all clips and uploads, keep users
+        """
+        with self.lock:
+            self.clips.clear()
+            self.uploads.clear()
+
+    def start_upload(self, user, device, chunks):
+        with self.lock:
+            self.last_upload_id += 1
+            upload_id = self.last_upload_id
+            self.uploads[upload_id] = {
+                "user": user,
+                "device": device,
+                "chunks": chunks,
+                "segments": {},
+            }
+        return upload_id
+
+    def get_upload(self, user, upload_id):
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+        if upload is None or upload["user"] != user:
+            return None
+        return upload
+
+    def complete_upload(self, user, upload_id):
+        """ Join segments of a complete upload into a clip
+        """
+        upload = self.get_upload(user, upload_id)
+        if upload is None or len(upload["segments"]) != upload["chunks"]:
+            return None
+        with self.lock:
+            del self.uploads[upload_id]
+        segments = [upload["segments"][index] for index in range(upload["chunks"])]
+        return self.add_clip(user, ".".join(segments), upload["device"])
+
+    def start(self):
+        """ Serve requests in a background thread
+        """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        with self.lock:
+            self.stopping = True
+            self.clips_added.notify_all()
+        self.shutdown()
+        self.server_close()
+
+
+def add_server_arguments(parser):
+    """ Add options for latency, faults and history of StubServer
+    """
+    parser.add_argument(
+        "--latency", type=float, default=0, metavar="MS", help="delay per request"
+    )
+    parser.add_argument(
+        "--jitter", type=float, default=0, metavar="MS", help="random extra delay"
+    )
+    parser.add_argument(
+        "--error-rate", type=float, default=0, help="share of requests failing"
+    )
+    parser.add_argument(
+        "--error-status", type=int, default=503, help="HTTP status of failures"
+    )
+    parser.add_argument(
+        "--drop-rate", type=float, default=0, help="share of dropped connections"
+    )
+    parser.add_argument(
+        "--history", type=int, default=0, help="clips kept per user, 0 keeps all"
+    )
+
+
+def get_server_options(args):
+    return {
+        "latency": args.latency / 1000,
+        "jitter": args.jitter / 1000,
+        "error_rate": args.error_rate,
+        "error_status": args.error_status,
+        "drop_rate": args.drop_rate,
+        "history": args.history,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    add_server_arguments(parser)
+    args = parser.parse_args()
+    server = StubServer(
+        args.host, args.port, verbose=True, **get_server_options(args)
+    )
+    print(f"Serving on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
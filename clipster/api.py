@@ -1,17 +1,29 @@
+import time
+import threading
 import requests
 import pyperclip
 import json
+import sqlite3
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     # for package import
     from .log_config import log
     from .config import Config
-    from .crypt import Crypt
+    from .crypt import Crypt, BinaryClip
+    from .cache import ClipCache
+    from .outbox import Outbox
+    from .stream import iter_batches, iter_decoded, iter_json_array
 except ModuleNotFoundError:
     # for direct call of clipster.py
     from log_config import log
     from config import Config
-    from crypt import Crypt
+    from crypt import Crypt, BinaryClip
+    from cache import ClipCache
+    from outbox import Outbox
+    from stream import iter_batches, iter_decoded, iter_json_array
 
 
 class ApiException(Exception):
@@ -21,6 +33,48 @@ class ApiException(Exception):
     pass
 
 
+class ClipTooLargeException(ApiException):
+    """ Clip exceeds the maximum size that may be shared
+    """
+
+    pass
+
+
+class ServerUnreachable(ApiException):
+    """ Request did not reach SERVER or SERVER is temporarily unavailable
+    """
+
+    pass
+
+
+class ClipRejected(ApiException):
+    """ SERVER refused the clip itself, sending it again would fail again
+    """
+
+    pass
+
+
+class ClipQueued(ApiException):
+    """ Clip was not shared yet but queued in the outbox
+    """
+
+    pass
+
+
+class BatchUploadUnsupported(ApiException):
+    """ Server does not accept several clips in one request
+    """
+
+    pass
+
+
+class ChunkedUploadUnsupported(ApiException):
+    """ Server does not accept chunked uploads
+    """
+
+    pass
+
+
 class RegisterException(Exception):
     """ Could not register user
     """
@@ -44,6 +98,16 @@ class Api:
     HASH_LOGIN = None
     HASH_MSG = None
     crypto = None
+    cache = None
+    outbox = None
+    last_pasted = None
+    latest_hash = None
+    latest_hash_at = 0
+    session = None
+    session_last_used = None
+    session_lock = threading.Lock()
+    batch_supported = None
+    chunked_supported = None
 
     def __init__(self, server, user, hash_login, hash_msg):
         self.SERVER = server
@@ -51,80 +115,804 @@ class Api:
         self.HASH_LOGIN = hash_login
         self.HASH_MSG = hash_msg
         self.crypto = Crypt(
-            username=user, password=None, hash_login=hash_login, hash_msg=hash_msg
+            username=user,
+            password=None,
+            hash_login=hash_login,
+            hash_msg=hash_msg,
+            compress=Config.COMPRESS_CLIPS,
+        )
+        self.validators = OrderedDict()
+        self.validators_lock = threading.Lock()
+        try:
+            self.cache = ClipCache(
+                Config.PATH_CACHE_FILE,
+                server,
+                hash_msg,
+                Config.CACHE_MAX_CLIPS,
+                Config.CACHE_MAX_BYTES,
+                Config.SEARCH_INDEX,
+            )
+        except (OSError, sqlite3.Error) as e:
+            log.error(f"Could not open clip cache: {e}")
+        try:
+            self.outbox = Outbox(
+                Config.PATH_OUTBOX_FILE, server, user, hash_msg, Config.OUTBOX_MAX_CLIPS
+            )
+        except (OSError, sqlite3.Error) as e:
+            log.error(f"Could not open outbox: {e}")
+
+    def close(self):
+        """ Release resources of this Api. The shared session stays open
+        """
+        if self.cache:
+            self.cache.close()
+            self.cache = None
+        if self.outbox:
+            self.outbox.close()
+            self.outbox = None
+
+    @staticmethod
+    def create_session():
+        """ Create a keep-alive session with a bounded connection pool that
+            retries failed connections and gateway errors with backoff
+        """
+        retry = Retry(
+            total=Config.MAX_RETRIES,
+            backoff_factor=Config.RETRY_BACKOFF,
+            status_forcelist=Config.RETRY_STATUS,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=Config.POOL_CONNECTIONS,
+            pool_maxsize=Config.POOL_MAXSIZE,
+            max_retries=retry,
         )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        session.headers.update(Config.HEADERS)
+        return session
+
+    @classmethod
+    def get_session(cls):
+        """ Return the session shared by all requests. Pooled connections
+            idle for longer than POOL_IDLE_TIMEOUT are dropped
+        """
+        with cls.session_lock:
+            now = time.monotonic()
+            if cls.session and now - cls.session_last_used > Config.POOL_IDLE_TIMEOUT:
+                log.debug("Closing idle connection pool")
+                cls.session.close()
+                cls.session = None
+            if not cls.session:
+                cls.session = cls.create_session()
+            cls.session_last_used = now
+            return cls.session
+
+    @classmethod
+    def request(cls, method, url, **kwargs):
+        """ Send request over the shared session using configured defaults
+        """
+        kwargs.setdefault("timeout", Config.CONN_TIMEOUT)
+        kwargs.setdefault("verify", Config.VERIFY_SSL_CERT)
+        return cls.get_session().request(method, url, **kwargs)
+
+    @staticmethod
+    def request_once(method, url, **kwargs):
+        """ Send request without retries, for requests the user waits for
+            interactively and would rather see fail fast
+        """
+        kwargs.setdefault("timeout", Config.CONN_TIMEOUT)
+        kwargs.setdefault("verify", Config.VERIFY_SSL_CERT)
+        kwargs.setdefault("headers", Config.HEADERS)
+        return requests.request(method, url, **kwargs)
 
-    def upload(self):
+    def warm_up(self):
+        """ Open a connection to SERVER in the background, so the first
+            tray action does not pay for TCP and TLS handshakes
         """
-        Send the copied text to SERVER
+        thread = threading.Thread(target=self._warm_up, daemon=True)
+        thread.start()
+        return thread
+
+    def _warm_up(self):
+        try:
+            self.request("HEAD", self.SERVER)
+        except requests.exceptions.RequestException as e:
+            log.debug(f"Could not warm up connection: {e}")
+        else:
+            log.debug("Connection pool warmed up")
+
+    def upload(self, clip=None):
+        """
+        Send clip or the copied text to SERVER. Clip may be text or a
+        BinaryClip. If SERVER is unreachable, or older clips are still
+        waiting in the outbox, the clip is queued there instead. Clips
+        that are already the newest one on SERVER are not sent again
+
+        Raises:
+            ClipQueued: Clip will be shared by the outbox sender
+        """
+        if clip is None:
+            clip = self.copy()
+        data = clip.data if isinstance(clip, BinaryClip) else clip.encode()
+        if len(data) > Config.MAX_CLIP_SIZE:
+            raise ClipTooLargeException(
+                f"Clip has a size of {len(data)} bytes, "
+                f"maximum is {Config.MAX_CLIP_SIZE}"
+            )
+        clip_hash = self.crypto.content_hash(clip)
+        if self.is_latest(clip_hash):
+            log.info("Clip is the newest one on SERVER already, not uploading")
+            return clip
+        if self.outbox and self.outbox.depth:
+            self.enqueue(self.crypto.encrypt(clip).decode())
+        if (
+            isinstance(clip, str)
+            and len(data) > Config.UPLOAD_CHUNK_SIZE
+            and self.chunked_supported is not False
+        ):
+            try:
+                self.upload_chunked(data)
+                self.chunked_supported = True
+                self.remember_latest(clip_hash)
+                return clip
+            except ChunkedUploadUnsupported:
+                log.info("SERVER does not support chunked uploads")
+                self.chunked_supported = False
+            except ServerUnreachable:
+                if not self.outbox:
+                    raise
+                self.enqueue(self.crypto.encrypt(clip).decode())
+        clip_encrypted = self.crypto.encrypt(clip).decode()
+        try:
+            self.send_clip(clip_encrypted)
+        except ServerUnreachable:
+            if not self.outbox:
+                raise
+            self.enqueue(clip_encrypted)
+        log.info("Success! Copied to Cloud-Clipboard.")
+        self.remember_latest(clip_hash)
+        return clip
+
+    def is_latest(self, clip_hash):
+        """ Is clip with content hash the newest one on SERVER? Other
+            devices may have shared clips unnoticed, so this is only
+            trusted for UPLOAD_DEDUPE_WINDOW seconds
+        """
+        age = time.monotonic() - self.latest_hash_at
+        return clip_hash == self.latest_hash and age < Config.UPLOAD_DEDUPE_WINDOW
+
+    def remember_latest(self, clip_hash):
+        """ Remember content hash of the newest clip on SERVER
+        """
+        self.latest_hash = clip_hash
+        self.latest_hash_at = time.monotonic()
+
+    def collapse_duplicates(self, clips):
+        """ Keep only the newest of clips with identical content
+
+        Returns:
+            List: Decrypted clips in their original order
+        """
+        seen = set()
+        unique = []
+        for clip in reversed(clips):
+            clip_hash = self.crypto.content_hash(clip)
+            if clip_hash not in seen:
+                seen.add(clip_hash)
+                unique.append(clip)
+        if len(unique) < len(clips):
+            log.debug(f"Collapsed {len(clips) - len(unique)} duplicate clips")
+        return unique[::-1]
+
+    def send_clip(self, clip_encrypted):
+        """ Post encrypted clip text to SERVER
+
+        Raises:
+            ServerUnreachable: Sending may succeed when retried later
+            ClipRejected: SERVER refused the clip
+            ApiException: SERVER refused the request, e.g. the credentials
         """
-        clip = self.copy()
-        clip_encrypted = self.crypto.encrypt(clip)
         payload = {"text": clip_encrypted, "device": f"{Config.DEVICE_ID}"}
         try:
-            res = requests.post(
+            res = self.request(
+                "POST",
                 self.SERVER + Config.API_COPY_PASTE,
                 data=payload,
                 auth=(self.USER, self.HASH_LOGIN),
-                timeout=Config.CONN_TIMEOUT,
-                verify=Config.VERIFY_SSL_CERT,
-                headers=Config.HEADERS,
             )
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ) as e:
+            log.warning(f"Cannot reach SERVER: {e}")
+            raise ServerUnreachable(e)
         except requests.exceptions.RequestException as e:
             log.exception("Error in upload request")
             raise ApiException(e)
-        else:
-            if res.status_code == 201:
-                log.info("Success! Copied to Cloud-Clipboard.")
-                return clip
-            else:
-                log.error(f"Error cannot upload clip: {res.text}")
-                raise ApiException(res.text[0 : Config.MAX_RESPONSE_LEN])
+        if res.status_code == 201:
+            return
+        if res.status_code in Config.RETRY_STATUS:
+            log.warning(f"SERVER unavailable: {res.status_code}")
+            raise ServerUnreachable(res.text[0 : Config.MAX_RESPONSE_LEN])
+        log.error(f"Error cannot upload clip: {res.text}")
+        if res.status_code in Config.REJECT_STATUS:
+            raise ClipRejected(res.text[0 : Config.MAX_RESPONSE_LEN])
+        raise ApiException(res.text[0 : Config.MAX_RESPONSE_LEN])
 
-    def download(self):
+    def send_clips(self, clips_encrypted):
+        """ Post encrypted clip texts to SERVER, UPLOAD_BATCH_SIZE per request.
+            If SERVER has no batch endpoint or refuses a batch as a whole,
+            e.g. as too large, its clips are posted one after the other over
+            the pooled connection. After a request failed for a reason other
+            than the clip itself, the remaining clips are not tried
+
+        Returns:
+            List: For every clip None if shared, else the ApiException. Only
+                ClipRejected means SERVER refused that very clip
+        """
+        results = []
+        size = Config.UPLOAD_BATCH_SIZE
+        for start in range(0, len(clips_encrypted), size):
+            batch = clips_encrypted[start : start + size]
+            if self.batch_supported is not False and len(batch) > 1:
+                try:
+                    results += self.send_batch(batch)
+                    continue
+                except BatchUploadUnsupported:
+                    log.info("SERVER does not support batch uploads")
+                    self.batch_supported = False
+                except ServerUnreachable as e:
+                    results += [e] * (len(clips_encrypted) - start)
+                    return results
+                except ApiException as e:
+                    log.info(f"SERVER refused batch, sending clips one by one: {e}")
+            for index, text in enumerate(batch):
+                try:
+                    self.send_clip(text)
+                except ClipRejected as e:
+                    results.append(e)
+                except ApiException as e:
+                    results += [e] * (len(clips_encrypted) - start - index)
+                    return results
+                else:
+                    results.append(None)
+        return results
+
+    def send_batch(self, clips_encrypted):
+        """ Post encrypted clip texts to SERVER in a single request. SERVER
+            answers 201 if all clips were stored, else 207 with the status
+            of every clip
+
+        Raises:
+            BatchUploadUnsupported: SERVER has no batch endpoint
+            ServerUnreachable: Sending may succeed when retried later
+            ApiException: SERVER refused the request as a whole
+
+        Returns:
+            List: For every clip None if shared, else ClipRejected
+        """
+        payload = {
+            "device": f"{Config.DEVICE_ID}",
+            "clips": [{"text": text} for text in clips_encrypted],
+        }
+        try:
+            res = self.request(
+                "POST",
+                self.SERVER + Config.API_BATCH,
+                json=payload,
+                auth=(self.USER, self.HASH_LOGIN),
+            )
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ) as e:
+            log.warning(f"Cannot reach SERVER: {e}")
+            raise ServerUnreachable(e)
+        except requests.exceptions.RequestException as e:
+            log.exception("Error in batch upload request")
+            raise ApiException(e)
+        if res.status_code in (404, 405):
+            raise BatchUploadUnsupported(res.status_code)
+        if res.status_code in Config.RETRY_STATUS:
+            log.warning(f"SERVER unavailable: {res.status_code}")
+            raise ServerUnreachable(res.text[0 : Config.MAX_RESPONSE_LEN])
+        self.batch_supported = True
+        if res.status_code == 201:
+            return [None] * len(clips_encrypted)
+        if res.status_code != 207:
+            log.warning(f"Error cannot upload clips: {res.text}")
+            raise ApiException(res.text[0 : Config.MAX_RESPONSE_LEN])
+        try:
+            statuses = res.json()["results"]
+        except (ValueError, KeyError) as e:
+            raise ApiException(f"Invalid response to batch upload: {e}")
+        if len(statuses) != len(clips_encrypted):
+            raise ApiException("Invalid response to batch upload: wrong length")
+        return [
+            None
+            if status.get("status") == 201
+            else ClipRejected(status.get("error", status.get("status")))
+            for status in statuses
+        ]
+
+    def enqueue(self, clip_encrypted):
+        """ Queue encrypted clip in the outbox
+
+        Raises:
+            ClipQueued: Always, as the clip has not been shared yet
+        """
+        self.outbox.add(clip_encrypted)
+        log.info(f"Queued clip in outbox, {self.outbox.depth} waiting")
+        raise ClipQueued(
+            f"Clip queued, {self.outbox.depth} Clips will be shared as soon as "
+            "SERVER is reachable"
+        )
+
+    def upload_chunked(self, data):
+        """ Send large text clip, encoded as UTF-8, to SERVER in separately
+            encrypted segments of up to UPLOAD_CHUNK_SIZE bytes, split
+            between characters. Only one segment is held encrypted at a
+            time. After a dropped connection, the upload is resumed with the
+            segments SERVER has not received yet. SERVER joins the segment
+            tokens with Crypt.SEGMENT_SEPARATOR into the clip text
+        """
+        url = self.SERVER + Config.API_UPLOAD
+        auth = (self.USER, self.HASH_LOGIN)
+        bounds = self.get_segment_bounds(data, Config.UPLOAD_CHUNK_SIZE)
+        total = len(bounds)
+        try:
+            res = self.request(
+                "POST",
+                url,
+                data={"device": Config.DEVICE_ID, "chunks": total},
+                auth=auth,
+            )
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ) as e:
+            log.warning(f"Cannot reach SERVER: {e}")
+            raise ServerUnreachable(e)
+        except requests.exceptions.RequestException as e:
+            log.exception("Error in upload request")
+            raise ApiException(e)
+        if res.status_code in (404, 405):
+            raise ChunkedUploadUnsupported(res.status_code)
+        if res.status_code != 201:
+            log.error(f"Error cannot start chunked upload: {res.text}")
+            raise ApiException(res.text[0 : Config.MAX_RESPONSE_LEN])
+        try:
+            upload_url = f"{url}{res.json()['id']}/"
+        except (ValueError, KeyError):
+            raise ApiException("Invalid response to chunked upload")
+        received = set()
+        for attempt in range(Config.UPLOAD_RESUME_ATTEMPTS + 1):
+            try:
+                if attempt:
+                    received = self.get_received_chunks(upload_url)
+                    log.info(f"Resuming upload, {len(received)}/{total} received")
+                for index, (start, end) in enumerate(bounds):
+                    if index in received:
+                        continue
+                    segment = self.crypto.encrypt_bytes(data[start:end], None)
+                    res = self.request(
+                        "PUT",
+                        f"{upload_url}{index}/",
+                        data={"text": segment},
+                        auth=auth,
+                    )
+                    if res.status_code >= 400:
+                        log.error(f"Error cannot upload chunk {index}: {res.text}")
+                        raise ApiException(res.text[0 : Config.MAX_RESPONSE_LEN])
+                res = self.request("POST", f"{upload_url}complete/", auth=auth)
+                break
+            except (
+                requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout,
+            ) as e:
+                log.warning(f"Chunked upload interrupted: {e}")
+                if attempt == Config.UPLOAD_RESUME_ATTEMPTS:
+                    raise ServerUnreachable(e)
+                time.sleep(Config.RETRY_BACKOFF * 2 ** attempt)
+        if res.status_code == 201:
+            log.info(f"Success! Copied {total} chunks to Cloud-Clipboard.")
+            return
+        log.error(f"Error cannot complete chunked upload: {res.text}")
+        raise ApiException(res.text[0 : Config.MAX_RESPONSE_LEN])
+
+    @staticmethod
+    def get_segment_bounds(data, size):
+        """ Split UTF-8 encoded text into segments of up to size bytes,
+            without splitting a multi-byte character
+
+        Returns:
+            List: Tuples of start and end offset of every segment
+        """
+        bounds = []
+        start = 0
+        while start < len(data):
+            end = min(start + size, len(data))
+            while end < len(data) and end > start + 1 and data[end] & 0xC0 == 0x80:
+                end -= 1
+            bounds.append((start, end))
+            start = end
+        return bounds
+
+    def get_received_chunks(self, upload_url):
+        """ Ask SERVER which segments of an upload it already has
+        """
+        res = self.request("GET", upload_url, auth=(self.USER, self.HASH_LOGIN))
+        if res.status_code != 200:
+            raise ApiException(res.text[0 : Config.MAX_RESPONSE_LEN])
+        return set(res.json().get("received", []))
+
+    def download(self, incremental=False, paste=True):
         """
         Download last or all clips from SERVER and updates the local clipboard
+        unless paste is False.
+        In incremental mode only clips newer than the stored cursor are
+        requested and decrypted, as collected from download_new. Otherwise
+        all clips are returned, as collected from iter_download. Without any
+        clips on SERVER, a notice is returned instead
         """
         log.info("downloading clips")
+        if incremental:
+            clips_decrypted = self.download_new()
+        else:
+            clips_decrypted = list(self.iter_download())
+        clips_decrypted = clips_decrypted or self.decrypt_clips([])
+        log.info(f"Got {len(clips_decrypted)} clips from SERVER")
+        if paste:
+            self.paste_clip(clips_decrypted[-1])
+        return clips_decrypted
+
+    def download_new(self):
+        """ Request clips newer than the stored cursor and decrypt them
+
+        Returns:
+            List: Decrypted new clips, else the clip of the cursor, empty if
+                there are no clips on SERVER
+        """
+        cursor = Config.read_cursor()
+        new_clips = self.fetch_new_clips(cursor)
+        clips = new_clips or ([cursor] if cursor else [])
+        self.store_clips(new_clips, cursor["id"] if cursor else None)
+        if not clips:
+            return []
+        if "id" in clips[-1]:
+            Config.write_cursor(clips[-1])
+        clips_decrypted = self.decrypt_clips(clips)
+        self.index_clips(clips, clips_decrypted)
+        self.remember_latest(self.crypto.content_hash(clips_decrypted[-1]))
+        return clips_decrypted
+
+    def iter_download(self):
+        """ Yield all clips decrypted, oldest first, as soon as they are read
+            from the local cache or streamed from SERVER. The cache holds the
+            newest clips, so only clips newer than those and, once clips were
+            evicted from it, the ones older than those are requested. Clips
+            are decrypted, cached and indexed DOWNLOAD_BATCH_SIZE at a time,
+            so memory use does not grow with the history. Updates cursor and
+            newest clip when exhausted
+        """
+        size = Config.DOWNLOAD_BATCH_SIZE
+        last_id = self.cache.get_last_id() if self.cache else None
+        evicted_id = self.cache.get_complete_since() if self.cache else None
+        sources = []
+        if evicted_id is not None:
+            log.info(f"Cache lacks clips up to {evicted_id}, downloading them")
+            sources.append((False, self.iter_clips_until(evicted_id)))
+        if last_id is not None:
+            sources.append((False, self.cache.iter_all(size)))
+        since_id = max(last_id or 0, evicted_id or 0) or None
+        sources.append((True, self.iter_clips({"id": since_id} if since_id else None)))
+        newest = None
+        for received, clips in sources:
+            for batch in iter_batches(clips, size):
+                if received and since_id:
+                    batch = self.filter_new_clips(batch, since_id)
+                    if not batch:
+                        continue
+                texts = self.crypto.decrypt_many(
+                    [clip["text"] for clip in batch], Config.DECRYPT_WORKERS
+                )
+                if received:
+                    self.store_clips(batch, since_id)
+                    self.index_clips(batch, texts)
+                    since_id = batch[-1].get("id", since_id)
+                newest = batch[-1], texts[-1]
+                yield from texts
+        if newest:
+            clip, text = newest
+            if "id" in clip:
+                Config.write_cursor(clip)
+            self.remember_latest(self.crypto.content_hash(text))
+
+    def iter_clips_until(self, last_id):
+        """ Stream clip list from SERVER up to clip last_id. The rest of the
+            response is not read
+        """
+        clips = self.iter_clips()
+        try:
+            for clip in clips:
+                if int(clip.get("id", 0)) > int(last_id):
+                    return
+                yield clip
+        finally:
+            clips.close()
+
+    def receive(self, wait=0):
+        """ Wait up to wait seconds for clips newer than the cursor and paste
+            the newest one. Without a cursor, the current clips are only
+            stored as starting point
+
+        Returns:
+            List: Decrypted new clips, empty if there are none
+        """
+        cursor = Config.read_cursor()
+        new_clips = self.fetch_new_clips(cursor, wait=wait if cursor else 0)
+        self.store_clips(new_clips, cursor["id"] if cursor else None)
+        if new_clips and "id" in new_clips[-1]:
+            Config.write_cursor(new_clips[-1])
+        if not cursor or not new_clips:
+            return []
+        clips_decrypted = self.decrypt_clips(new_clips)
+        self.index_clips(new_clips, clips_decrypted)
+        self.remember_latest(self.crypto.content_hash(clips_decrypted[-1]))
+        log.info(f"Received {len(clips_decrypted)} new clips from SERVER")
+        self.paste_clip(clips_decrypted[-1])
+        return clips_decrypted
+
+    def paste_clip(self, clip):
+        """ Paste received text clip, unless the clipboard holds it already.
+            Binary clips need the GUI clipboard and are pasted by the tray
+        """
+        if isinstance(clip, BinaryClip):
+            return
+        self.last_pasted = clip
+        if self.copy() == clip:
+            log.debug("Clipboard holds received clip already, not pasting")
+            return
+        self.paste(clip)
+
+    def store_clips(self, clips, since_id=None):
+        """ Add clips received from SERVER after clip since_id, or from the
+            oldest one on, to local cache
+        """
+        if self.cache:
+            self.cache.add(clips, since_id)
+
+    def index_clips(self, clips, clips_decrypted):
+        """ Add decrypted text clips to the search index of the cache
+        """
+        if not self.cache or len(clips) != len(clips_decrypted):
+            return
+        self.cache.index(
+            {
+                int(clip["id"]): text
+                for clip, text in zip(clips, clips_decrypted)
+                if "id" in clip and isinstance(text, str)
+            }
+        )
+
+    def search(self, query):
+        """ Find cached clips containing all words of query without contacting
+            SERVER. With a search index, only matching clips are decrypted
+
+        Returns:
+            List: Up to SEARCH_LIMIT newest matching clips, decrypted
+        """
+        if not self.cache:
+            return []
+        if self.cache.has_index:
+            clips = self.cache.search(query, Config.SEARCH_LIMIT)
+            return self.crypto.decrypt_many(
+                [clip["text"] for clip in clips], Config.DECRYPT_WORKERS
+            )
+        words = query.lower().split()
+        matches = []
+        for batch in iter_batches(
+            self.cache.iter_all(Config.DOWNLOAD_BATCH_SIZE), Config.DOWNLOAD_BATCH_SIZE
+        ):
+            clips = self.crypto.decrypt_many(
+                [clip["text"] for clip in batch], Config.DECRYPT_WORKERS
+            )
+            matches += [
+                clip
+                for clip in clips
+                if isinstance(clip, str) and all(word in clip.lower() for word in words)
+            ]
+            del matches[: -Config.SEARCH_LIMIT]
+        return matches
+
+    def fetch_new_clips(self, cursor=None, wait=0):
+        """ Request clips newer than cursor from SERVER, or all without one
+        """
+        clips = self.fetch_clips(cursor, wait)
+        if cursor:
+            clips = self.filter_new_clips(clips, cursor["id"])
+            log.info(f"{len(clips)} new clips on SERVER")
+        return clips
+
+    def fetch_clips(self, cursor=None, wait=0):
+        """ Request clip list from SERVER. With a cursor, only ask for clips
+            newer than it, letting the server hold the request for up to
+            wait seconds until there are any
+
+        Returns:
+            List: Clip objects as returned by SERVER
+        """
+        return list(self.iter_clips(cursor, wait))
+
+    def iter_clips(self, cursor=None, wait=0):
+        """ Stream clip list from SERVER and yield clip objects while the
+            response body is parsed chunk by chunk. If SERVER reports the
+            list as not modified, the clips of the previous response are read
+            from the cache, which stored them when they were received
+        """
+        res, key = self.request_clips(cursor, wait)
+        if res.status_code == 304:
+            res.close()
+            log.info("Clips not modified since last download")
+            yield from self.get_unmodified_clips(key)
+            return
+        validator = self.get_validator(res)
+        try:
+            chunks = iter_decoded(
+                res.iter_content(chunk_size=Config.STREAM_CHUNK_SIZE), res.encoding
+            )
+            for clip in iter_json_array(chunks):
+                yield clip
+        except requests.exceptions.RequestException as e:
+            log.exception("Error in download request")
+            raise ApiException(e)
+        except ValueError as e:
+            log.error(f"Could not parse response: {e}")
+            raise ApiException(e)
+        finally:
+            res.close()
+        if validator:
+            self.remember_validator(key, validator)
+
+    def request_clips(self, cursor=None, wait=0):
+        """ Send streamed, conditional clip list request. Falls back to a
+            full sync if the server rejects the incremental filter
+
+        Returns:
+            tuple: Response and key of its validator
+        """
         url = self.SERVER + Config.API_COPY_PASTE
+        key = (url, cursor["id"] if cursor else None)
+        params = {Config.API_PARAM_SINCE: cursor["id"]} if cursor else None
+        if params and wait:
+            params[Config.API_PARAM_WAIT] = wait
+        auth = (self.USER, self.HASH_LOGIN)
         try:
-            res = requests.get(
-                url=url,
-                auth=(self.USER, self.HASH_LOGIN),
-                timeout=Config.CONN_TIMEOUT,
-                verify=Config.VERIFY_SSL_CERT,
-                headers=Config.HEADERS,
+            res = self.request(
+                "GET",
+                url,
+                params=params,
+                auth=auth,
+                headers=self.get_conditional_headers(key),
+                stream=True,
+                timeout=Config.CONN_TIMEOUT + wait,
             )
+            if params and res.status_code == 400:
+                log.info("SERVER does not support incremental sync")
+                res.close()
+                key = (url, None)
+                res = self.request(
+                    "GET",
+                    url,
+                    auth=auth,
+                    headers=self.get_conditional_headers(key),
+                    stream=True,
+                )
         except requests.exceptions.RequestException as e:
             log.exception("Error in download request")
             raise ApiException(e)
-        else:
-            if res.status_code == 200:
-                clips_decrypted = self.parse_and_decrypt_response(res)
-                log.info(f"Got new clips from SERVER:\n{clips_decrypted}")
-                self.paste(clips_decrypted[-1])
-                return clips_decrypted
-            else:
-                log.error(f"Cannot download clips: {res.status_code} - {res.text}")
-                raise ApiException(res.text[0 : Config.MAX_RESPONSE_LEN])
+        if res.status_code not in (200, 304):
+            log.error(f"Cannot download clips: {res.status_code} - {res.text}")
+            raise ApiException(res.text[0 : Config.MAX_RESPONSE_LEN])
+        return res, key
+
+    @staticmethod
+    def get_validator(response):
+        """ Return ETag and Last-Modified of response, None if it has neither
+        """
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return None
+        return etag, last_modified
+
+    def get_conditional_headers(self, key):
+        """ Return If-None-Match / If-Modified-Since headers for a request
+            whose previous response we remember and could serve from cache
+        """
+        with self.validators_lock:
+            validator = self.validators.get(key)
+        if not validator or not self.cache or not self.cache.is_complete(key[1]):
+            return {}
+        etag, last_modified = validator
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        return headers
+
+    def remember_validator(self, key, validator):
+        """ Keep validator of a complete response for the next conditional
+            request. Its clips are not kept, they are cached when received
+        """
+        with self.validators_lock:
+            self.validators[key] = validator
+            self.validators.move_to_end(key)
+            while len(self.validators) > Config.MAX_VALIDATORS:
+                self.validators.popitem(last=False)
+
+    def get_unmodified_clips(self, key):
+        """ Return clips of the remembered response for a 304 answer from
+            the cache
+        """
+        with self.validators_lock:
+            known = key in self.validators
+        if not known or not self.cache:
+            raise ApiException("Got 304 for a request that was not conditional")
+        return self.cache.get_all(key[1])
+
+    @staticmethod
+    def filter_new_clips(clips, last_id):
+        """ Keep clips newer than last_id. Servers that ignore the incremental
+            filter return the full list which is reduced to the delta here
+        """
+        try:
+            return [clip for clip in clips if int(clip["id"]) > int(last_id)]
+        except (KeyError, TypeError, ValueError):
+            log.warning("Clips have no usable id, cannot sync incrementally")
+            return clips
+
+    @staticmethod
+    def parse_response(response):
+        """ Parse list clip response
+
+        Returns:
+            List: Clip objects as returned by SERVER
+        """
+        try:
+            return json.loads(response.text)
+        except ValueError as e:
+            log.error(f"Could not parse response: {e}")
+            return []
+
+    def decrypt_clips(self, clips):
+        """ Decrypt text of clip objects
 
-    def parse_and_decrypt_response(self, response):
-        """ Parse list clip response and decrypt content
         Returns:
             List: Contains one or more clips. Ordered by creation date (DESC)
         """
         clips_decrypted = []
         try:
-            clips = json.loads(response.text)
-            for clip in clips:
-                clips_decrypted.append(self.crypto.decrypt(clip["text"]))
+            clips_decrypted = self.crypto.decrypt_many(
+                [clip["text"] for clip in clips], Config.DECRYPT_WORKERS
+            )
             if len(clips) == 0:
                 clips_decrypted = ["There are no shared Clips yet"]
         except Exception as e:
-            log.e(f"Could not parse and decrypt: {e}")
+            log.error(f"Could not decrypt: {e}")
             clips_decrypted = [""]
         return clips_decrypted
 
+    def parse_and_decrypt_response(self, response):
+        """ Parse list clip response and decrypt content
+        Returns:
+            List: Contains one or more clips. Ordered by creation date (DESC)
+        """
+        return self.decrypt_clips(self.parse_response(response))
+
     @staticmethod
     def paste(data):
         """
@@ -149,13 +937,7 @@ class Api:
         login_hash = crypto.pw_hash_login
         payload = {"username": user, "password": login_hash}
         try:
-            res = requests.post(
-                server + Config.API_REGISTER,
-                data=payload,
-                timeout=Config.CONN_TIMEOUT,
-                verify=Config.VERIFY_SSL_CERT,
-                headers=Config.HEADERS,
-            )
+            res = Api.request_once("POST", server + Config.API_REGISTER, data=payload)
         except requests.exceptions.RequestException as e:
             log.exception("Error in register request")
             raise RegisterException(e)
@@ -174,12 +956,8 @@ class Api:
         crypto = Crypt(user, pw)
         login_hash = crypto.pw_hash_login
         try:
-            res = requests.get(
-                server + Config.API_LOGIN,
-                auth=(user, login_hash),
-                timeout=Config.CONN_TIMEOUT,
-                verify=Config.VERIFY_SSL_CERT,
-                headers=Config.HEADERS,
+            res = Api.request_once(
+                "GET", server + Config.API_LOGIN, auth=(user, login_hash)
             )
         except requests.exceptions.RequestException as e:
             log.exception("Error in login request")
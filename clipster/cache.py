@@ -0,0 +1,385 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+try:
+    # for package import
+    from .log_config import log
+except ModuleNotFoundError:
+    # for direct call of clipster.py
+    from log_config import log
+
+
+class ClipCache:
+    """ Local on-disk cache of received clips, keyed by server clip id.
+        Clips are stored still encrypted and evicted oldest first when
+        exceeding max_clips or max_bytes, so the cache always holds a gapless
+        run of the newest clips: all clips newer than the highest evicted
+        id. If enabled, decrypted text clips are indexed for full-text search
+        in a contentless FTS5 table, which keeps the index terms but not the
+        text itself. These terms are plaintext, so the index is opt-in
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+        CREATE TABLE IF NOT EXISTS clips (
+            id INTEGER PRIMARY KEY,
+            text TEXT NOT NULL,
+            device TEXT,
+            created_at TEXT,
+            size INTEGER NOT NULL,
+            last_access REAL NOT NULL
+        );
+    """
+    FTS_SCHEMA = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS clips_fts USING fts5(
+            text, content='', tokenize='unicode61 remove_diacritics 2'{options}
+        )
+    """
+
+    def __init__(
+        self, path, server, hash_msg, max_clips, max_bytes, search_index=False
+    ):
+        """ Open cache and clear it if it was filled for another server or key
+
+        Args:
+            path (pathlib.Path): Database file
+            server (str): Server the clips are received from
+            hash_msg (str): PW Hash for crypto the clips are encrypted with
+            max_clips (int): Maximum number of cached clips
+            max_bytes (int): Maximum total size of cached clips
+            search_index (bool): Index decrypted clips for full-text search
+        """
+        self.max_clips = max_clips
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch(mode=0o600, exist_ok=True)
+        os.chmod(path, 0o600)
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.has_index, self.can_unindex = False, False
+        dropped = False
+        with self.lock, self.conn:
+            self.conn.executescript(self.SCHEMA)
+            if search_index:
+                self.has_index, self.can_unindex = self.create_index()
+            else:
+                dropped = self.drop_index()
+        if dropped:
+            self.conn.execute("VACUUM")
+        self.validate(self.get_fingerprint(server, hash_msg))
+
+    def create_index(self):
+        """ Create search index. Removing single clips from it needs SQLite
+            3.43, older versions keep evicted clips in the index until it is
+            cleared. Clips cached before the index existed are dropped, so
+            they are indexed when received again. Must be called holding the
+            lock
+
+        Returns:
+            tuple: Whether index exists and whether clips can be removed
+        """
+        existed = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'clips_fts'"
+        ).fetchone()
+        for options, can_unindex in ((", contentless_delete=1", True), ("", False)):
+            try:
+                self.conn.execute(self.FTS_SCHEMA.format(options=options))
+            except sqlite3.OperationalError as e:
+                log.debug(f"Cannot create search index with '{options}': {e}")
+                continue
+            sql = self.conn.execute(
+                "SELECT sql FROM sqlite_master WHERE name = 'clips_fts'"
+            ).fetchone()[0]
+            if not existed:
+                self.conn.execute("DELETE FROM clips")
+                self.conn.execute("DELETE FROM meta WHERE key = 'evicted_id'")
+            return True, can_unindex and "contentless_delete" in sql
+        log.warning("SQLite has no FTS5, searching clips without index")
+        return False, False
+
+    def drop_index(self):
+        """ Delete search index of a cache it was enabled for before. Must be
+            called holding the lock
+
+        Returns:
+            bool: Whether there was an index
+        """
+        existed = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'clips_fts'"
+        ).fetchone()
+        if existed:
+            log.info("Search index disabled, deleting it")
+            self.conn.execute("DROP TABLE clips_fts")
+        return existed is not None
+
+    @staticmethod
+    def get_fingerprint(server, hash_msg):
+        """ Identify server and crypto key without storing the key itself
+        """
+        return hashlib.sha256(f"{server}|{hash_msg}".encode()).hexdigest()
+
+    def validate(self, fingerprint):
+        """ Invalidate cache if server or crypto key changed
+        """
+        with self.lock, self.conn:
+            row = self.conn.execute(
+                "SELECT value FROM meta WHERE key = 'fingerprint'"
+            ).fetchone()
+            if row and row[0] == fingerprint:
+                return
+            if row:
+                log.info("Server or key changed, clearing clip cache")
+            self.conn.execute("DELETE FROM clips")
+            self.conn.execute("DELETE FROM meta WHERE key = 'evicted_id'")
+            self.clear_index()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('fingerprint', ?)",
+                (fingerprint,),
+            )
+
+    def add(self, clips, since_id=None):
+        """ Store clips received from server and evict old entries
+
+        Args:
+            clips (list): Clip objects as returned by server, ordered by id
+            since_id (int): Id the clips were requested after, None if they
+                start with the oldest clip on server. If the cache does not
+                reach up to it, clips in between may be missing, so the
+                cached ones before are evicted
+        """
+        now = time.time()
+        rows = [
+            (
+                int(clip["id"]),
+                clip["text"],
+                clip.get("device"),
+                clip.get("created_at"),
+                len(clip["text"]),
+                now,
+            )
+            for clip in clips
+            if "id" in clip
+        ]
+        if not rows:
+            return
+        with self.lock, self.conn:
+            if since_id is not None and not self.reaches(int(since_id)):
+                log.debug(f"Cache misses clips before {since_id}")
+                self.evict_until(int(since_id))
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO clips "
+                "(id, text, device, created_at, size, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.evict()
+
+    def reaches(self, clip_id):
+        """ Whether all clips up to clip_id were cached, even if evicted
+            since. Must be called holding the lock
+        """
+        last_id = self.conn.execute("SELECT MAX(id) FROM clips").fetchone()[0]
+        return max(last_id or 0, self.get_evicted_id() or 0) >= clip_id
+
+    def evict(self):
+        """ Delete oldest clips until limits are met. Must be called holding
+            the lock
+        """
+        count, size = self.conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM clips"
+        ).fetchone()
+        if count <= self.max_clips and size <= self.max_bytes:
+            return
+        evicted_id = None
+        rows = self.conn.execute("SELECT id, size FROM clips ORDER BY id")
+        for clip_id, clip_size in rows:
+            if count <= self.max_clips and size <= self.max_bytes:
+                break
+            count -= 1
+            size -= clip_size
+            evicted_id = clip_id
+        self.evict_until(evicted_id)
+
+    def evict_until(self, clip_id):
+        """ Delete clips up to clip_id and keep the highest evicted id. Must
+            be called holding the lock
+        """
+        if self.can_unindex:
+            self.conn.execute(
+                "DELETE FROM clips_fts WHERE rowid IN "
+                "(SELECT id FROM clips WHERE id <= ?)",
+                (clip_id,),
+            )
+        evicted = self.conn.execute(
+            "DELETE FROM clips WHERE id <= ?", (clip_id,)
+        ).rowcount
+        evicted_id = max(self.get_evicted_id() or 0, clip_id)
+        self.conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('evicted_id', ?)",
+            (str(evicted_id),),
+        )
+        log.debug(f"Evicted {evicted} clips from cache")
+
+    def get_evicted_id(self):
+        """ Return highest id of evicted clips, None if none were evicted.
+            Must be called holding the lock
+        """
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'evicted_id'"
+        ).fetchone()
+        return int(row[0]) if row else None
+
+    def get_complete_since(self):
+        """ Return id after which the cache holds all clips received from
+            server, None if it holds all of them
+        """
+        with self.lock:
+            return self.get_evicted_id()
+
+    def is_complete(self, since_id=None):
+        """ Whether the cache holds all clips received from server that are
+            newer than since_id, or all of them. No clip is missing before
+            the first one is evicted
+        """
+        with self.lock:
+            evicted_id = self.get_evicted_id()
+        return evicted_id is None or (
+            since_id is not None and evicted_id <= int(since_id)
+        )
+
+    def get_last_id(self):
+        """ Return id of the newest cached clip, None if cache is empty
+        """
+        with self.lock:
+            return self.conn.execute("SELECT MAX(id) FROM clips").fetchone()[0]
+
+    def get_all(self, since_id=None):
+        """ Return cached clips newer than since_id, or all, ordered by id
+
+        Returns:
+            List: Clip objects as returned by server
+        """
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT id, text, device, created_at FROM clips WHERE id > ? "
+                "ORDER BY id",
+                (int(since_id or 0),),
+            ).fetchall()
+        return [
+            {"id": clip_id, "text": text, "device": device, "created_at": created_at}
+            for clip_id, text, device, created_at in rows
+        ]
+
+    def iter_all(self, batch_size):
+        """ Yield all cached clips ordered by id, reading batch_size of them
+            at a time
+
+        Yields:
+            dict: Clip objects as returned by server
+        """
+        last_id = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT id, text, device, created_at FROM clips WHERE id > ? "
+                    "ORDER BY id LIMIT ?",
+                    (last_id, batch_size),
+                ).fetchall()
+            for clip_id, text, device, created_at in rows:
+                yield {
+                    "id": clip_id,
+                    "text": text,
+                    "device": device,
+                    "created_at": created_at,
+                }
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1][0]
+
+    def index(self, texts):
+        """ Add decrypted text of cached clips to search index, unless they
+            are indexed already
+
+        Args:
+            texts (dict): Decrypted text by clip id
+        """
+        if not self.has_index or not texts:
+            return
+        with self.lock, self.conn:
+            rows = [
+                (clip_id, text)
+                for clip_id, text in texts.items()
+                if self.is_cached(clip_id) and not self.is_indexed(clip_id)
+            ]
+            self.conn.executemany(
+                "INSERT INTO clips_fts (rowid, text) VALUES (?, ?)", rows
+            )
+        if rows:
+            log.debug(f"Indexed {len(rows)} clips for search")
+
+    def is_cached(self, clip_id):
+        """ Must be called holding the lock
+        """
+        sql = "SELECT 1 FROM clips WHERE id = ?"
+        return self.conn.execute(sql, (clip_id,)).fetchone() is not None
+
+    def is_indexed(self, clip_id):
+        """ Must be called holding the lock
+        """
+        sql = "SELECT 1 FROM clips_fts WHERE rowid = ?"
+        return self.conn.execute(sql, (clip_id,)).fetchone() is not None
+
+    @staticmethod
+    def get_match_query(query):
+        """ Turn words of user query into FTS5 query, matching clips that
+            contain all of them, the last word as prefix
+        """
+        words = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+        if words:
+            words[-1] += "*"
+        return " ".join(words)
+
+    def search(self, query, limit):
+        """ Return newest cached clips whose text matches all words of query
+
+        Returns:
+            List: Clip objects as returned by server, ordered by id
+        """
+        match = self.get_match_query(query)
+        if not match:
+            return []
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT clips.id, clips.text, clips.device, clips.created_at "
+                "FROM clips_fts JOIN clips ON clips.id = clips_fts.rowid "
+                "WHERE clips_fts MATCH ? ORDER BY clips.id DESC LIMIT ?",
+                (match, limit),
+            ).fetchall()
+        return [
+            {"id": clip_id, "text": text, "device": device, "created_at": created_at}
+            for clip_id, text, device, created_at in reversed(rows)
+        ]
+
+    def clear_index(self):
+        """ Remove all clips from search index. Must be called holding the lock
+        """
+        if self.has_index:
+            self.conn.execute("INSERT INTO clips_fts (clips_fts) VALUES ('delete-all')")
+
+    def clear(self):
+        """ Remove all cached clips
+        """
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM clips")
+            self.conn.execute("DELETE FROM meta WHERE key = 'evicted_id'")
+            self.clear_index()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
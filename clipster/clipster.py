@@ -1,21 +1,31 @@
 import sys
-import os
+import time
+import argparse
+import threading
+import subprocess
 from pathlib import Path
+from concurrent.futures import wait
 
 try:
     # for package import
     from .config import Config
     from .log_config import log
-    from .gui import Gui
-    from .api import Api, ApiException
-    from .crypt import Crypt
+    from .crypt import BinaryClip
+    from .worker import Worker
+    from .watcher import ClipboardWatcher
+    from .configwatch import ConfigWatcher
+    from .lazy import lazy_import
+    from . import ipc
 except ModuleNotFoundError:
     # for direct call of clipster.py
     from config import Config
     from log_config import log
-    from gui import Gui
-    from api import Api, ApiException
-    from crypt import Crypt
+    from crypt import BinaryClip
+    from worker import Worker
+    from watcher import ClipboardWatcher
+    from configwatch import ConfigWatcher
+    from lazy import lazy_import
+    import ipc
 
 
 def get_cred(mygui):
@@ -25,12 +35,28 @@ def get_cred(mygui):
     mygui.ask_for_cred()
 
 
-def set_clip(mygui, api):
-    """ Upload current clip to server and display tray notification
+def set_clip(mygui, api, worker):
+    """ Upload current clip to server in background. Images are read from
+        the clipboard here, as only the GUI thread may access them
+    """
+    worker.submit("Share Clip", api.upload, mygui.copy_binary())
+
+
+def show_set_clip_result(mygui, future, notify_success=True):
+    """ Display tray notification for finished upload
     """
     try:
-        clip = api.upload()
-    except ApiException as e:
+        clip = future.result()
+    except lazy_import("api").ClipQueued as e:
+        if not notify_success:
+            return
+        mygui.tray.show_message(
+            f"{Config.APP_NAME} - Clip queued",
+            f"{e}",
+            data_base64=Config.ICON_B64,
+            time=Config.SHOW_MESSAGE_DURATION,
+        )
+    except Exception as e:
         mygui.tray.show_message(
             f"{Config.APP_NAME} - Share Clip Error",
             f"Error sharing Clip:\n{e}",
@@ -38,21 +64,47 @@ def set_clip(mygui, api):
             time=Config.SHOW_MESSAGE_DURATION,
         )
     else:
+        if not notify_success:
+            return
         mygui.tray.show_message(
             f"{Config.APP_NAME} - shared Clip",
-            f"{clip[0:Config.MAX_NOTIFY_LEN]}",
+            f"{str(clip)[0:Config.MAX_NOTIFY_LEN]}",
             data_base64=Config.ICON_B64,
             time=Config.SHOW_MESSAGE_DURATION,
         )
 
 
-def get_clip(mygui, api, all_clips=False):
-    """ Download clips from server and display single tray notification
-        or list of all Clips
+def show_outbox_result(mygui, future):
+    """ Display tray notification for queued clips shared by the sender
+    """
+    sent, rejected = future.result()
+    message = f"Shared {sent} queued Clips"
+    if rejected:
+        message += f"\n{rejected} Clips were rejected by the server"
+    mygui.tray.show_message(
+        f"{Config.APP_NAME} - shared queued Clips",
+        message,
+        data_base64=Config.ICON_B64,
+        time=Config.SHOW_MESSAGE_DURATION,
+    )
+
+
+def get_clip(mygui, api, worker, all_clips=False):
+    """ Download clips from server in background
+    """
+    if all_clips:
+        worker.submit("Get all Clips", api.download, coalesce=True)
+    else:
+        worker.submit("Get last Clip", api.download, incremental=True, coalesce=True)
+
+
+def show_get_clip_result(mygui, api, worker, future, all_clips=False):
+    """ Display single tray notification or searchable list of all Clips
+        for finished download. Searches run on the worker
     """
     try:
-        clips = api.download()
-    except ApiException as e:
+        clips = future.result()
+    except Exception as e:
         mygui.tray.show_message(
             f"{Config.APP_NAME} - Get Clip Error",
             f"Error downloading Clip:\n{e}",
@@ -61,61 +113,257 @@ def get_clip(mygui, api, all_clips=False):
         )
     else:
         if all_clips:
-            mygui.show_clip_list_window(clips)
+            mygui.show_clip_list_window(
+                api.collapse_duplicates(clips),
+                lambda query: worker.submit(
+                    "Search Clips",
+                    lambda: api.collapse_duplicates(api.search(query)),
+                ),
+            )
             return True
         else:
+            if isinstance(clips[-1], BinaryClip):
+                mygui.paste_binary(clips[-1])
             mygui.tray.show_message(
                 f"{Config.APP_NAME} - Got Clip",
-                f"{clips[-1][0:Config.MAX_NOTIFY_LEN]}",
+                f"{str(clips[-1])[0:Config.MAX_NOTIFY_LEN]}",
                 data_base64=Config.ICON_B64,
                 time=Config.SHOW_MESSAGE_DURATION,
             )
             return True
 
 
-def deal_with_tray_event(mygui, api, event):
+def deal_with_tray_event(mygui, api, worker, event):
     """ React to menu actions in tray
     """
     log.info(event)
     if event == "Get last Clip":
-        get_clip(mygui, api, False)
-    if event == "Get all Clips":
-        get_clip(mygui, api, True)
+        get_clip(mygui, api, worker, False)
+    elif event == "Get all Clips":
+        get_clip(mygui, api, worker, True)
     elif event == "Share Clip":
-        set_clip(mygui, api)
+        set_clip(mygui, api, worker)
     elif event == "Edit Credentials":
         get_cred(mygui)
     elif event == "Exit":
+        worker.shutdown()
         sys.exit(0)
 
 
+def deal_with_results(mygui, api, worker):
+    """ Show results of finished background actions in tray
+    """
+    for action, future in worker.get_results():
+        if action == "Share Clip":
+            show_set_clip_result(mygui, future)
+        elif action == ClipboardWatcher.ACTION:
+            show_set_clip_result(mygui, future, notify_success=False)
+        elif action in ("Get last Clip", lazy_import("receiver").ClipReceiver.ACTION):
+            show_get_clip_result(mygui, api, worker, future, False)
+        elif action == "Get all Clips":
+            show_get_clip_result(mygui, api, worker, future, True)
+        elif action == lazy_import("sender").OutboxSender.ACTION:
+            show_outbox_result(mygui, future)
+
+
+def start_background_services(mygui, api, worker):
+    """ Start outbox sender, and clipboard watcher and receiver if enabled
+        in config
+    """
+    services = []
+    if api.outbox:
+        services.append(lazy_import("sender").OutboxSender(api, worker))
+    if Config.AUTO_SHARE:
+        services.append(ClipboardWatcher(api, worker, mygui.watch_clipboard))
+    if Config.AUTO_RECEIVE:
+        services.append(lazy_import("receiver").ClipReceiver(api, worker))
+    for service in services:
+        service.start()
+    return services
+
+
+def reload_config(mygui, api, worker, services, ipc_server=None):
+    """ Rebuild Api and background services from modified config file.
+        Tray, worker threads and connection pool are kept
+
+    Returns:
+        tuple: Api and background services to use from now on
+    """
+    if not Config.is_configfile_valid():
+        log.error("Modified config is invalid, keeping current one")
+        return api, services
+    log.info("Reloading config")
+    for service in services:
+        service.stop()
+    tasks = worker.cancel_all()
+    Api = lazy_import("api").Api
+    new_api = Api(Config.SERVER, Config.USER, Config.PW_HASH_LOGIN, Config.PW_HASH_MSG)
+    new_api.warm_up()
+    if ipc_server:
+        ipc_server.api = new_api
+    if not close_api(api, services, tasks, ipc_server, Config.SERVICE_STOP_TIMEOUT):
+        log.warning("Old config still in use, closing it when its tasks finish")
+        threading.Thread(
+            target=close_api, args=(api, services, tasks, ipc_server), daemon=True
+        ).start()
+    return new_api, start_background_services(mygui, new_api, worker)
+
+
+def close_api(api, services, tasks, ipc_server=None, timeout=None):
+    """ Close Api once stopped services, running tasks and IPC requests no
+        longer use it, so none of them hits its closed cache or outbox
+
+    Returns:
+        bool: Whether Api was closed within timeout
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def remaining():
+        return None if deadline is None else max(0, deadline - time.monotonic())
+
+    for service in services:
+        service.join(remaining())
+    wait(tasks, remaining())
+    idle = ipc_server.wait_idle(remaining()) if ipc_server else True
+    if not idle or any(service.is_alive() for service in services):
+        return False
+    if not all(task.done() for task in tasks):
+        return False
+    api.close()
+    return True
+
+
 def wait_for_tray_event(mygui, server, username, hash_login, hash_msg):
     """ Check for config modification while waiting for action in systray
+        Network actions run in background, so the tray stays responsive
     """
     log.debug("Main Loop\n")
     log.debug(f"{server} - {username} - {hash_login} - {hash_msg}")
-    api = Api(server, username, hash_login, hash_msg)
+    api = lazy_import("api").Api(server, username, hash_login, hash_msg)
+    api.warm_up()
+    worker = Worker(Config.WORKER_THREADS)
+    services = start_background_services(mygui, api, worker)
+    ipc_server = ipc.start_server(api)
+    config_watcher = ConfigWatcher(
+        Config.PATH_CONFIG_FILE, Config.CONFIG_CHECK_INTERVAL
+    )
+    Config.was_configfile_modified()
+    outbox_depth = 0
 
     while True:
-        if Config.was_configfile_modified():
+        if config_watcher.was_modified():
             log.info("Configfile was modified.")
-            self_restart()
-        event = mygui.tray.read()
-        deal_with_tray_event(mygui, api, event)
+            api, services = reload_config(mygui, api, worker, services, ipc_server)
+        event = mygui.read_tray_event(timeout=Config.TRAY_POLL_INTERVAL)
+        deal_with_results(mygui, api, worker)
+        if api.outbox and api.outbox.depth != outbox_depth:
+            outbox_depth = api.outbox.depth
+            mygui.show_outbox_depth(outbox_depth)
+        if event:
+            deal_with_tray_event(mygui, api, worker, event)
+
+
+def profile_startup(limit=25):
+    """ Report import time of the modules loaded when starting the tray,
+        measured in a fresh interpreter with -X importtime
+    """
+    if getattr(sys, "frozen", False):
+        print("Startup profiling is not available in the packaged app")
+        return
+    modules = ["gui", "api", "receiver"]
+    package = __package__ or None
+    names = [f"{package}.{module}" if package else module for module in modules]
+    code = "import " + ", ".join(names)
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=None if package else str(Path(__file__).parent),
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    timings = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        is_toplevel = not name.startswith("  ")
+        timings.append((int(cumulative_us), int(self_us), name.strip(), is_toplevel))
+    if result.returncode != 0 or not timings:
+        print(result.stderr)
+        return
+    total = sum(timing[0] for timing in timings if timing[3])
+    print(f"Total import time: {total / 1000:.1f} ms\n")
+    print(f"{'cumulative [ms]':>16} {'self [ms]':>10}  module")
+    for cumulative, self_us, name, _ in sorted(timings, reverse=True)[:limit]:
+        print(f"{cumulative / 1000:16.1f} {self_us / 1000:10.1f}  {name}")
 
 
-def self_restart():
-    """ self restart after configuration change
+def positive_int(value):
+    """ Argument type of counts, which must be at least 1
     """
-    log.debug("Restarting program")
-    python = sys.executable
-    os.execl(python, python, *sys.argv)
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a number of at least 1: {value}")
+    return number
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        prog="clipster",
+        description=f"{Config.APP_NAME} - Multi Platform Cloud Clipboard",
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help="report import time per module loaded at startup and exit",
+    )
+    commands = parser.add_subparsers(dest="command")
+    share_parser = commands.add_parser(
+        "share", help="share text read from stdin without starting the tray"
+    )
+    share_parser.add_argument(
+        "--mime", help="share stdin as binary data of this MIME type, e.g. image/png"
+    )
+    get_parser = commands.add_parser(
+        "get", help="write shared clips to stdout without starting the tray"
+    )
+    selection = get_parser.add_mutually_exclusive_group()
+    selection.add_argument("--all", action="store_true", help="get all clips")
+    selection.add_argument(
+        "--last", type=positive_int, default=1, metavar="N", help="get last N clips"
+    )
+    get_parser.add_argument(
+        "-0",
+        "--null",
+        action="store_true",
+        help="terminate clips with NUL instead of newline",
+    )
+    search_parser = commands.add_parser(
+        "search", help="write locally cached clips containing all words to stdout"
+    )
+    search_parser.add_argument("words", nargs="+", help="words to search for")
+    search_parser.add_argument(
+        "-0",
+        "--null",
+        action="store_true",
+        help="terminate clips with NUL instead of newline",
+    )
+    return parser.parse_args(args)
 
 
 def main():
-    """ Make sure config is valid and start main loop
+    """ Make sure config is valid and start main loop. The tray is shown
+        before requests and cryptography are loaded
     """
-    mygui = Gui()
+    args = parse_args()
+    if args.profile_startup:
+        profile_startup()
+        return
+    if args.command:
+        sys.exit(lazy_import("headless").run(args))
+    mygui = lazy_import("gui").Gui()
     while not Config.is_configfile_valid():
         log.debug("No valid config file")
         get_cred(mygui)
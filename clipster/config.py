@@ -1,6 +1,7 @@
+import os
+import json
 import platform
 import configparser
-import PySimpleGUIQt as sg
 from pathlib import Path
 
 try:
@@ -18,7 +19,27 @@ class Config:
     APP_NAME = "Clipster"
     DEFAULT_SERVER_URI = "https://clipster.cc"
     SHOW_MESSAGE_DURATION = 2000
+    TRAY_POLL_INTERVAL = 100
+    SEARCH_DEBOUNCE = 300
+    CONFIG_CHECK_INTERVAL = 2
+    WORKER_THREADS = 2
+    WATCH_INTERVAL_MIN = 0.25
+    WATCH_INTERVAL_MAX = 2.0
+    WATCH_DEBOUNCE = 0.5
+    AUTO_SHARE_MIN_INTERVAL = 2.0
+    LONG_POLL_WAIT = 30
+    RECEIVE_POLL_INTERVAL = 10
+    EVENTS_READ_TIMEOUT = 90
+    RECONNECT_BACKOFF_MIN = 1
+    RECONNECT_BACKOFF_MAX = 60
     CONN_TIMEOUT = 6
+    POOL_CONNECTIONS = 2
+    POOL_MAXSIZE = 4
+    POOL_IDLE_TIMEOUT = 300
+    MAX_RETRIES = 3
+    RETRY_BACKOFF = 0.5
+    RETRY_STATUS = (502, 503, 504)
+    REJECT_STATUS = (400, 413, 422)
     MATCH_NONWHITESPACE = r"\S.*"
     MATCH_SERVER = (
         r"^(https):\/\/[^\s\/$.?#].[^\s]*|http://localhost:|http://127.0.0.1:"
@@ -26,22 +47,57 @@ class Config:
     DEVICE_ID = f"desktop_{platform.node()}"
     PATH_CONFIG_DIR = Path.home() / ".config/clipster/"
     PATH_CONFIG_FILE = PATH_CONFIG_DIR / "config"
+    PATH_CURSOR_FILE = PATH_CONFIG_DIR / "cursor"
+    PATH_CACHE_FILE = PATH_CONFIG_DIR / "cache.db"
+    PATH_OUTBOX_FILE = PATH_CONFIG_DIR / "outbox.db"
+    PATH_IPC_SOCKET = PATH_CONFIG_DIR / "clipster.sock"
+    IPC_TIMEOUT = 60
+    SERVICE_STOP_TIMEOUT = 10
+    CACHE_MAX_CLIPS = 1000
+    OUTBOX_MAX_CLIPS = 100
+    OUTBOX_BATCH_SIZE = 20
+    OUTBOX_CHECK_INTERVAL = 60
+    CACHE_MAX_BYTES = 20 * 1024 * 1024
+    STREAM_CHUNK_SIZE = 64 * 1024
+    DOWNLOAD_BATCH_SIZE = 100
+    MAX_VALIDATORS = 8
+    MAX_CLIP_SIZE = 16 * 1024 * 1024
+    UPLOAD_CHUNK_SIZE = 512 * 1024
+    UPLOAD_RESUME_ATTEMPTS = 3
+    UPLOAD_BATCH_SIZE = 20
+    UPLOAD_DEDUPE_WINDOW = 120
+    MAX_IMAGE_DIMENSION = 2048
+    MAX_IMAGE_SIZE = 2 * 1024 * 1024
+    IMAGE_JPEG_QUALITY = 85
+    THUMBNAIL_SIZE = 160
+    DECRYPT_WORKERS = min(4, os.cpu_count() or 1)
     CONFIGFILE_MTIME = None
     MAX_NOTIFY_LEN = 60
     MAX_RESPONSE_LEN = 400
     MAX_CLIP_PREVIEW_LEN = 200
+    HISTORY_PAGE_SIZE = 100
+    SEARCH_LIMIT = 200
     MIN_PW_LENGTH = 8
 
     HEADERS = {"Accept": "application/json"}
     API_COPY_PASTE = "/copy-paste/"
     API_REGISTER = "/register/"
     API_LOGIN = "/verify-user/"
+    API_EVENTS = "/copy-paste/events/"
+    API_UPLOAD = "/copy-paste/upload/"
+    API_BATCH = "/copy-paste/batch/"
+    API_PARAM_SINCE = "since_id"
+    API_PARAM_WAIT = "wait"
     SERVER = None
     USER = None
     PW = None
     PW_HASH_LOGIN = None
     PW_HASH_MSG = None
     VERIFY_SSL_CERT = True
+    AUTO_SHARE = False
+    AUTO_RECEIVE = False
+    COMPRESS_CLIPS = False
+    SEARCH_INDEX = False
 
     def __init__(self):
         pass
@@ -51,13 +107,17 @@ class Config:
         """ Check if configfile has been changed since last modificatiom
         """
         log.debug("Checking if configfile has been modified")
-        if cls.CONFIGFILE_MTIME:
+        try:
             mtime = Path(cls.PATH_CONFIG_FILE).stat().st_mtime
+        except OSError:
+            return False
+        if cls.CONFIGFILE_MTIME:
             if mtime > cls.CONFIGFILE_MTIME:
+                cls.CONFIGFILE_MTIME = mtime
                 return True
             else:
                 return False
-        cls.CONFIGFILE_MTIME = Path(cls.PATH_CONFIG_FILE).stat().st_mtime
+        cls.CONFIGFILE_MTIME = mtime
         return False
 
     @classmethod
@@ -74,6 +134,18 @@ class Config:
                 cls.PW_HASH_LOGIN = conf.get("settings", "hash_login")
                 cls.PW_HASH_MSG = conf.get("settings", "hash_msg")
                 cls.VERIFY_SSL_CERT = conf.getboolean("settings", "verify_ssl_cert")
+                cls.AUTO_SHARE = conf.getboolean(
+                    "settings", "auto_share", fallback=False
+                )
+                cls.AUTO_RECEIVE = conf.getboolean(
+                    "settings", "auto_receive", fallback=False
+                )
+                cls.COMPRESS_CLIPS = conf.getboolean(
+                    "settings", "compress_clips", fallback=False
+                )
+                cls.SEARCH_INDEX = conf.getboolean(
+                    "settings", "search_index", fallback=False
+                )
             except (configparser.NoSectionError, KeyError):
                 return False
             if cls.SERVER and cls.USER and cls.PW_HASH_LOGIN and cls.PW_HASH_MSG:
@@ -98,13 +170,53 @@ class Config:
             "hash_login": crypto.pw_hash_login,
             "hash_msg": crypto.pw_hash_msg,
             "verify_ssl_cert": cls.VERIFY_SSL_CERT,
+            "auto_share": cls.AUTO_SHARE,
+            "auto_receive": cls.AUTO_RECEIVE,
+            "compress_clips": cls.COMPRESS_CLIPS,
+            "search_index": cls.SEARCH_INDEX,
         }
         with open(cls.PATH_CONFIG_FILE, "w") as configfile:
             config.write(configfile)
+        if cls.PATH_CURSOR_FILE.exists():
+            cls.PATH_CURSOR_FILE.unlink()
         if not cls.CONFIGFILE_MTIME:
             cls.CONFIGFILE_MTIME = Path(cls.PATH_CONFIG_FILE).stat().st_mtime
         return True
 
+    @classmethod
+    def read_cursor(cls):
+        """ Return last seen clip of current server and user or None
+        """
+        try:
+            with open(cls.PATH_CURSOR_FILE) as cursorfile:
+                cursor = json.load(cursorfile)
+        except (OSError, ValueError):
+            return None
+        if cursor.get("server") != cls.SERVER or cursor.get("user") != cls.USER:
+            log.debug("Cursor belongs to other server or user")
+            return None
+        if "id" not in cursor or "text" not in cursor:
+            return None
+        return cursor
+
+    @classmethod
+    def write_cursor(cls, clip):
+        """ Remember last seen clip (still encrypted) for incremental syncs
+        """
+        cursor = {
+            "server": cls.SERVER,
+            "user": cls.USER,
+            "id": clip["id"],
+            "created_at": clip.get("created_at"),
+            "text": clip["text"],
+        }
+        cls.PATH_CONFIG_DIR.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(cls.PATH_CURSOR_FILE, "w") as cursorfile:
+                json.dump(cursor, cursorfile)
+        except OSError as e:
+            log.error(f"Could not write cursor: {e}")
+
     # PNG Icon 128x128 encoded with base64
     ICON_B64 = b"""iVBORw0KGgoAAAANSUhEUgAAAIAAAACACAYAAADDPmHLAAAABmJLR0QA/wD/AP+gvaeTAAAACXBI
                 WXMAAC4jAAAuIwF4pT92AAAAB3RJTUUH5AofFCUzT8cWAQAACRlJREFUeF7tnFtIFF8cx3+7rrne
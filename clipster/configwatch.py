@@ -0,0 +1,95 @@
+import os
+import sys
+import time
+import struct
+import ctypes
+import ctypes.util
+from pathlib import Path
+
+try:
+    # for package import
+    from .config import Config
+    from .log_config import log
+except ModuleNotFoundError:
+    # for direct call of clipster.py
+    from config import Config
+    from log_config import log
+
+
+class ConfigWatcher:
+    """ Detect modifications of the config file. Uses inotify on Linux and
+        falls back to checking the modification time every interval seconds
+    """
+
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, path, interval):
+        """
+        Args:
+            path (pathlib.Path): Config file to watch
+            interval (float): Seconds between modification time checks
+        """
+        self.path = Path(path)
+        self.interval = interval
+        self.next_check = 0
+        self.fd = None
+        if sys.platform.startswith("linux"):
+            try:
+                self.fd = self.init_inotify()
+                log.debug("Watching configfile with inotify")
+            except (OSError, AttributeError) as e:
+                log.debug(f"Cannot use inotify, polling configfile: {e}")
+
+    def init_inotify(self):
+        """ Watch directory of config file, so that files replaced by
+            editors are noticed as well
+        """
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = libc.inotify_add_watch(fd, bytes(self.path.parent), mask)
+        if wd < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        return fd
+
+    def was_modified(self):
+        """ Has the config file been modified since the last call?
+        """
+        if self.fd is None:
+            return self.poll_mtime()
+        modified = False
+        while True:
+            try:
+                data = os.read(self.fd, 4096)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                _, _, _, length = self.EVENT_HEADER.unpack_from(data, offset)
+                start = offset + self.EVENT_HEADER.size
+                name = data[start : start + length].rstrip(b"\0")
+                offset = start + length
+                if name == os.fsencode(self.path.name):
+                    modified = True
+        return modified
+
+    def poll_mtime(self):
+        now = time.monotonic()
+        if now < self.next_check:
+            return False
+        self.next_check = now + self.interval
+        return Config.was_configfile_modified()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
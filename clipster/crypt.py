@@ -1,8 +1,11 @@
+import re
+import hmac
+import zlib
 import base64
-from cryptography.fernet import Fernet
-from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.fernet import InvalidToken
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 try:
     # for package import
@@ -22,18 +25,54 @@ class DecryptException(Exception):
     """
 
 
+class BinaryClip:
+    """ Clip of binary data, e.g. an image, with its MIME type
+    """
+
+    def __init__(self, data, mime):
+        self.data = data
+        self.mime = mime
+        self.thumbnail = None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __str__(self):
+        return f"[{self.mime}, {max(1, len(self.data) // 1024)} KB]"
+
+    def is_image(self):
+        return self.mime.startswith("image/")
+
+
 class Crypt:
-    """ Symmetric encryption / decryption of clipboard data using Fernet
+    """ Symmetric encryption / decryption of clipboard data using Fernet.
+        cryptography is imported on first use to keep startup fast
     """
 
     HASH_ITERS_LOGIN = 20000
     HASH_ITERS_MSG = 10000
     HASH_LENGTH = 32
+    MEMO_MAX_BYTES = 8 * 1024 * 1024
+    BATCH_MIN_SIZE = 32
+    ENVELOPE_MAGIC = b"\x00CLP"
+    ENVELOPE_VERSION = 2
+    ENVELOPE_VERSION_TEXT = 1
+    ENVELOPE_FLAG_ZLIB = 1
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_LEVEL = 6
+    SEGMENT_SEPARATOR = b"."
+    CONTENT_HASH_CONTEXT = b"clipster content hash"
+    MAX_DERIVED_KEYS = 4
+    derived_keys = OrderedDict()
+    derived_keys_lock = threading.Lock()
+    compress = False
     fernet = None
     pw_hash_login = None
     pw_hash_msg = None
 
-    def __init__(self, username, password, hash_login=None, hash_msg=None):
+    def __init__(
+        self, username, password, hash_login=None, hash_msg=None, compress=False
+    ):
         """ Create / Set hashes to be used for login and crypto by hashing the
             user's password. Initialize Fernet with crypto hash
 
@@ -42,17 +81,53 @@ class Crypt:
             password (str): Login cleartext password
             hash_login (str): PW Hash for authentication
             hash_msg (str): PW Hash for crypto
+            compress (bool): Compress large clips before encryption
         """
+        self.compress = compress
         self.pw_hash_login = hash_login
         self.pw_hash_msg = hash_msg
         if password:
-            salt = f"clipster_{username}_{password}".encode()
-            password = password.encode()
-            self.pw_hash_login = self.get_hash(password, salt, self.HASH_ITERS_LOGIN)
-            self.pw_hash_msg = self.get_hash(password, salt, self.HASH_ITERS_MSG)
+            self.pw_hash_login, self.pw_hash_msg = self.derive_keys(username, password)
+        from cryptography.fernet import Fernet
+
         self.fernet = Fernet(self.pw_hash_msg)
+        self.content_hash_key = hmac.new(
+            self.pw_hash_msg.encode(), self.CONTENT_HASH_CONTEXT, hashlib.sha256
+        ).digest()
+        self.memo = OrderedDict()
+        self.memo_bytes = 0
+        self.memo_hits = 0
+        self.memo_misses = 0
+        self.memo_lock = threading.Lock()
+
+    @classmethod
+    def derive_keys(cls, username, password):
+        """ Return login and crypto hash of credentials. They are derived
+            once and reused for the same credentials, e.g. for login and
+            writing the config
+
+        Returns:
+            tuple: Login hash and crypto hash
+        """
+        key = hashlib.sha256(f"{username}\0{password}".encode()).digest()
+        with cls.derived_keys_lock:
+            if key in cls.derived_keys:
+                cls.derived_keys.move_to_end(key)
+                return cls.derived_keys[key]
+        salt = f"clipster_{username}_{password}".encode()
+        password = password.encode()
+        derived = (
+            cls.get_hash(password, salt, cls.HASH_ITERS_LOGIN),
+            cls.get_hash(password, salt, cls.HASH_ITERS_MSG),
+        )
+        with cls.derived_keys_lock:
+            cls.derived_keys[key] = derived
+            while len(cls.derived_keys) > cls.MAX_DERIVED_KEYS:
+                cls.derived_keys.popitem(last=False)
+        return derived
 
-    def get_hash(self, password, salt, iterations):
+    @classmethod
+    def get_hash(cls, password, salt, iterations):
         """ Create PBKDF2 Hash of password
 
         Args:
@@ -63,9 +138,12 @@ class Crypt:
         Returns:
             str: Base64 urlsafe hash
         """
+        from cryptography.hazmat.primitives import hashes
+        from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+
         kdf = PBKDF2HMAC(
             algorithm=hashes.SHA256(),
-            length=self.HASH_LENGTH,
+            length=cls.HASH_LENGTH,
             salt=salt,
             iterations=iterations,
         )
@@ -73,21 +151,203 @@ class Crypt:
         hashh = base64.urlsafe_b64encode(hashh)
         return hashh.decode()
 
+    def content_hash(self, clip):
+        """ Keyed hash of clip content. Identical clips have the same hash,
+            which reveals nothing about them without the crypto key
+
+        Args:
+            clip (str or BinaryClip): Decrypted clip
+
+        Returns:
+            bytes: HMAC-SHA256 digest
+        """
+        mac = hmac.new(self.content_hash_key, digestmod=hashlib.sha256)
+        if isinstance(clip, BinaryClip):
+            mac.update(clip.mime.encode() + b"\0")
+            mac.update(clip.data)
+        else:
+            mac.update(b"\0")
+            mac.update(clip.encode())
+        return mac.digest()
+
     def encrypt(self, data):
-        """ Returns encrypted text
+        """ Returns encrypted text, or encrypted bytes of a BinaryClip
         """
-        data = data.encode()
+        if isinstance(data, BinaryClip):
+            return self.encrypt_bytes(data.data, data.mime)
+        data = self.pack(data.encode())
         encrypted = self.fernet.encrypt(data)
         return encrypted
 
+    def encrypt_bytes(self, data, mime):
+        """ Returns encrypted binary data of given MIME type
+        """
+        return self.fernet.encrypt(self.pack(data, mime))
+
     def decrypt(self, data):
-        """ Return encrypted text
+        """ Return decrypted text, or BinaryClip for binary data. Clips
+            uploaded in chunks consist of several tokens joined by
+            SEGMENT_SEPARATOR. Results are memoized by token digest, so
+            tokens received again are not decrypted twice
         """
+        from cryptography.fernet import InvalidToken
+
         data = data.encode()
+        digest = hashlib.sha256(data).digest()
+        clear = self.memo_get(digest)
+        if clear is not None:
+            return clear
         try:
-            clear = self.fernet.decrypt(data)
-        except InvalidToken as e:
+            segments = [
+                self.unpack(self.fernet.decrypt(segment))
+                for segment in data.split(self.SEGMENT_SEPARATOR)
+            ]
+        except (InvalidToken, DecryptException) as e:
             log.exception(f"ERROR Decrypt: {e}")
-            clear = "Error: Could not decrypt received clip".encode()
-        clear = clear.decode()
+            return "Error: Could not decrypt received clip"
+        mime = segments[0][0]
+        clear = b"".join(payload for _, payload in segments)
+        size = len(clear)
+        clear = BinaryClip(clear, mime) if mime else clear.decode()
+        self.memo_put(digest, clear, size)
         return clear
+
+    def pack(self, data, mime=None):
+        """ Wrap data into a versioned envelope. Text is only wrapped if
+            compression is enabled and worthwhile, or if it starts like an
+            envelope itself, so that clients without envelope support can
+            still read it. Binary data is always wrapped to carry its MIME
+            type
+
+        Args:
+            data (bytes): Plaintext
+            mime (str): MIME type of binary data, None for text
+
+        Returns:
+            bytes: Plaintext or envelope
+        """
+        flags = 0
+        payload = data
+        if self.compress and len(data) >= self.COMPRESS_MIN_SIZE:
+            compressed = zlib.compress(data, self.COMPRESS_LEVEL)
+            if len(compressed) < len(data):
+                flags |= self.ENVELOPE_FLAG_ZLIB
+                payload = compressed
+        if mime:
+            mime = mime.encode()
+            header = self.ENVELOPE_MAGIC + bytes(
+                [self.ENVELOPE_VERSION, flags, len(mime)]
+            )
+            return header + mime + payload
+        if not flags and not data.startswith(self.ENVELOPE_MAGIC):
+            return data
+        header = self.ENVELOPE_MAGIC + bytes([self.ENVELOPE_VERSION_TEXT, flags])
+        return header + payload
+
+    @classmethod
+    def unpack(cls, data):
+        """ Return MIME type and plaintext of envelope. Data that is not
+            wrapped in a valid one is text, with None as MIME type, as other
+            clients may share text starting like an envelope
+        """
+        if not data.startswith(cls.ENVELOPE_MAGIC):
+            return None, data
+        try:
+            return cls.parse_envelope(data)
+        except DecryptException as e:
+            log.debug(f"Not a clip envelope, reading it as text: {e}")
+            return None, data
+
+    @classmethod
+    def parse_envelope(cls, data):
+        """ Return MIME type and plaintext of envelope, which starts with the
+            magic, a version, flags and for binary data the MIME type
+
+        Raises:
+            DecryptException: Envelope is unsupported or corrupt
+        """
+        pos = len(cls.ENVELOPE_MAGIC) + 2
+        if len(data) < pos:
+            raise DecryptException("Truncated clip envelope")
+        version, flags = data[pos - 2 : pos]
+        if version not in (cls.ENVELOPE_VERSION_TEXT, cls.ENVELOPE_VERSION):
+            raise DecryptException(f"Unsupported clip envelope version {version}")
+        if flags & ~cls.ENVELOPE_FLAG_ZLIB:
+            raise DecryptException(f"Unsupported clip envelope flags {flags}")
+        mime = None
+        if version == cls.ENVELOPE_VERSION:
+            mime_len = data[pos] if len(data) > pos else 0
+            mime = data[pos + 1 : pos + 1 + mime_len]
+            if len(mime) != mime_len or not re.fullmatch(rb"[\w.+-]+/[\w.+-]+", mime):
+                raise DecryptException("Invalid MIME type in clip envelope")
+            mime = mime.decode()
+            pos += 1 + mime_len
+        payload = data[pos:]
+        if flags & cls.ENVELOPE_FLAG_ZLIB:
+            try:
+                payload = zlib.decompress(payload)
+            except zlib.error as e:
+                raise DecryptException(f"Corrupt compressed clip: {e}")
+        return mime, payload
+
+    def decrypt_many(self, tokens, workers=1):
+        """ Decrypt a list of tokens, fanned out to a thread pool for large
+            batches. Undecryptable tokens yield the same error text as decrypt
+
+        Args:
+            tokens (list): Encrypted texts
+            workers (int): Maximum number of decrypting threads
+
+        Returns:
+            list: Decrypted texts or BinaryClips in the order of tokens
+        """
+        if workers <= 1 or len(tokens) < self.BATCH_MIN_SIZE:
+            return [self.decrypt(token) for token in tokens]
+        chunksize = max(1, len(tokens) // (workers * 4))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(self.decrypt, tokens, chunksize=chunksize))
+
+    def memo_get(self, digest):
+        """ Return memoized plaintext of token digest or None
+        """
+        with self.memo_lock:
+            entry = self.memo.get(digest)
+            if entry is None:
+                self.memo_misses += 1
+                return None
+            self.memo_hits += 1
+            self.memo.move_to_end(digest)
+        return entry[0]
+
+    def memo_put(self, digest, clear, size):
+        """ Memoize plaintext of size bytes, evicting least recently used
+            entries to stay below MEMO_MAX_BYTES
+        """
+        if size > self.MEMO_MAX_BYTES:
+            return
+        with self.memo_lock:
+            if digest in self.memo:
+                return
+            self.memo[digest] = (clear, size)
+            self.memo_bytes += size
+            while self.memo_bytes > self.MEMO_MAX_BYTES:
+                _, (_, evicted_size) = self.memo.popitem(last=False)
+                self.memo_bytes -= evicted_size
+
+    def memo_clear(self):
+        """ Drop all memoized plaintexts
+        """
+        with self.memo_lock:
+            self.memo.clear()
+            self.memo_bytes = 0
+
+    def memo_stats(self):
+        """ Return memoization counters for tuning MEMO_MAX_BYTES
+        """
+        with self.memo_lock:
+            return {
+                "hits": self.memo_hits,
+                "misses": self.memo_misses,
+                "entries": len(self.memo),
+                "bytes": self.memo_bytes,
+            }
@@ -1,20 +1,24 @@
 import PySimpleGUIQt as sg
 import re
+import time
+import base64
+import threading
+from PySide2.QtCore import QBuffer, QByteArray, QIODevice, QMimeData, Qt
+from PySide2.QtGui import QGuiApplication, QImage
+from PySide2.QtWidgets import QListView
 
 try:
     # for package import
     from .config import Config
     from .log_config import log
-    from .crypt import Crypt
-    from .api import Api
-    from .api import RegisterException, LoginException
+    from .crypt import Crypt, BinaryClip
+    from .lazy import lazy_import
 except ModuleNotFoundError:
     # for direct call of clipster.py
     from config import Config
     from log_config import log
-    from crypt import Crypt
-    from api import Api
-    from api import RegisterException, LoginException
+    from crypt import Crypt, BinaryClip
+    from lazy import lazy_import
 
 
 class Gui:
@@ -55,6 +59,27 @@ class Gui:
         sg.theme("Clipster")
         self.tray = sg.SystemTray(menu=self.menu_def, data_base64=Config.ICON_B64)
 
+    def show_outbox_depth(self, depth):
+        """ Show number of clips waiting in the outbox in tray menu and tooltip
+        """
+        if not depth:
+            self.tray.update(menu=self.menu_def, tooltip=Config.APP_NAME)
+            return
+        status = f"{depth} Clips waiting to be shared"
+        menu = ["BLANK", [f"!{status}", "---", *self.menu_def[1]]]
+        self.tray.update(menu=menu, tooltip=f"{Config.APP_NAME} - {status}")
+
+    def read_tray_event(self, timeout=None):
+        """ Wait up to timeout ms for a tray event
+
+        Returns:
+            str: Menu entry clicked or None if timed out
+        """
+        event = self.tray.read(timeout=timeout)
+        if event == sg.TIMEOUT_KEY:
+            return None
+        return event
+
     def create_cred_layout(self):
         """ Layouts in simplepyguy cannot be reused
             need to create new one when (re)-opening windows
@@ -96,36 +121,231 @@ class Gui:
         ]
         return layout
 
-    def show_clip_list_window(self, clips):
-        """ Show all received clips in a Windows with a Listview and allow
-            user select and copy an entry
+    def show_clip_list_window(self, clips, search=None):
+        """ Show received clips newest first in a window and allow user to
+            select and copy one. Previews of HISTORY_PAGE_SIZE clips are
+            listed at first and older ones are paged in when scrolling to
+            the end. Full text or image is only shown for the selected clip.
+            If a search function is given, the list is filtered while typing.
+            It is called SEARCH_DEBOUNCE ms after the last keystroke and must
+            return a future of the matching clips, so the window stays
+            responsive while searching
         """
-        # TODO: Show Only preview of Clip to reduce length
+        history = clips[::-1]
         layout = [
             [
                 sg.Listbox(
-                    values=clips,
+                    values=[],
                     size=(60, 6),
                     select_mode="LISTBOX_SELECT_MODE_SINGLE",
+                    enable_events=True,
                     key="sel_clip",
                 )
             ],
+            [sg.Multiline(size=(60, 6), disabled=True, visible=False, key="text")],
+            [sg.Image(key="thumbnail", visible=False)],
             [sg.Button("Copy to clipboard", size=(20, 1)), sg.Cancel(size=(20, 1))],
         ]
+        if search:
+            search_input = sg.Input(key="search", enable_events=True)
+            layout.insert(0, [sg.Text("Search:", size=(8, 1)), search_input])
         window = sg.Window(
             title=f"{Config.APP_NAME} - Your Clips",
             layout=layout,
-            size=(600, 300),
+            size=(600, 450),
             icon=Config.ICON_B64,
+            finalize=True,
         )
-        event, values = window.read()
-        if event in (sg.WIN_CLOSED, "Cancel"):
-            log.debug("List Clips selection canceled")
-            pass
-        elif event == "Copy to clipboard":
-            Api.paste(values.get("sel_clip")[0])
+        list_widget = window["sel_clip"].QT_ListWidget
+        list_widget.setUniformItemSizes(True)
+        list_widget.setLayoutMode(QListView.Batched)
+        self.load_clip_page(list_widget, history)
+        list_widget.verticalScrollBar().valueChanged.connect(
+            lambda value: self.on_clip_list_scrolled(list_widget, history, value)
+        )
+        query, search_at, searching = None, None, None
+        while True:
+            waiting = search_at is not None or searching is not None
+            timeout = Config.TRAY_POLL_INTERVAL if waiting else None
+            event, values = window.read(timeout=timeout)
+            if event in (sg.WIN_CLOSED, "Cancel"):
+                log.debug("List Clips selection canceled")
+                break
+            if event == "search":
+                query = values["search"].strip()
+                search_at = time.monotonic() + Config.SEARCH_DEBOUNCE / 1000
+                continue
+            if search_at is not None and time.monotonic() >= search_at:
+                search_at = None
+                searching = search(query) if query else None
+                if not query:
+                    self.show_clip_history(window, list_widget, history, clips)
+            if searching is not None and searching.done():
+                if not searching.cancelled() and not searching.exception():
+                    results = searching.result()
+                    self.show_clip_history(window, list_widget, history, results)
+                searching = None
+            if event == sg.TIMEOUT_KEY:
+                continue
+            row = list_widget.currentRow()
+            if row < 0:
+                continue
+            clip = history[row]
+            if event == "sel_clip":
+                self.show_clip(window, clip)
+            elif event == "Copy to clipboard":
+                self.paste_clip(clip)
+                break
         window.close()
 
+    def show_clip_history(self, window, list_widget, history, clips):
+        """ Replace listed clips by clips, showing the newest first
+        """
+        history[:] = clips[::-1]
+        list_widget.clear()
+        self.load_clip_page(list_widget, history)
+        window["text"].update(visible=False)
+        window["thumbnail"].update(visible=False)
+
+    def on_clip_list_scrolled(self, list_widget, history, value):
+        """ Page in older clips when list is scrolled to the end
+        """
+        if value == list_widget.verticalScrollBar().maximum():
+            self.load_clip_page(list_widget, history)
+
+    def load_clip_page(self, list_widget, history):
+        """ Append previews of the next HISTORY_PAGE_SIZE clips to list
+        """
+        start = list_widget.count()
+        page = history[start : start + Config.HISTORY_PAGE_SIZE]
+        if page:
+            log.debug(f"Listing clips {start} to {start + len(page)}")
+            list_widget.addItems([self.get_preview(clip) for clip in page])
+
+    @staticmethod
+    def get_preview(clip):
+        """ Return first MAX_CLIP_PREVIEW_LEN characters of clip on one line
+        """
+        if isinstance(clip, BinaryClip):
+            return str(clip)
+        preview = " ".join(clip[0 : Config.MAX_CLIP_PREVIEW_LEN].split())
+        if len(clip) > Config.MAX_CLIP_PREVIEW_LEN:
+            preview += "..."
+        return preview
+
+    def show_clip(self, window, clip):
+        """ Show full text of selected text clip or preview of image clip
+        """
+        is_text = not isinstance(clip, BinaryClip)
+        window["text"].update(value=clip if is_text else "", visible=is_text)
+        self.show_thumbnail(window, clip)
+
+    def show_thumbnail(self, window, clip):
+        """ Show preview of image clips, hide it for all others
+        """
+        if isinstance(clip, BinaryClip) and clip.is_image():
+            thumbnail = self.get_thumbnail(clip)
+            if thumbnail:
+                window["thumbnail"].update(data_base64=thumbnail, visible=True)
+                return
+        window["thumbnail"].update(visible=False)
+
+    def get_thumbnail(self, clip):
+        """ Return base64 PNG thumbnail of image clip. It is only created
+            when first needed and kept with the clip
+        """
+        if clip.thumbnail is None:
+            image = QImage.fromData(clip.data)
+            if image.isNull():
+                return None
+            image = image.scaled(
+                Config.THUMBNAIL_SIZE,
+                Config.THUMBNAIL_SIZE,
+                Qt.KeepAspectRatio,
+                Qt.SmoothTransformation,
+            )
+            clip.thumbnail = base64.b64encode(self.encode_image(image, "PNG"))
+        return clip.thumbnail
+
+    @staticmethod
+    def encode_image(image, image_format, quality=-1):
+        """ Return image encoded in image_format as bytes
+        """
+        array = QByteArray()
+        buffer = QBuffer(array)
+        buffer.open(QIODevice.WriteOnly)
+        image.save(buffer, image_format, quality)
+        buffer.close()
+        return bytes(array)
+
+    def watch_clipboard(self, callback):
+        """ Call callback with the clipboard text whenever it changes. Qt
+            emits the signal on the GUI thread while tray events are read,
+            so nothing runs while the clipboard is unchanged
+
+        Returns:
+            callable: Stops watching, None if Qt cannot watch the clipboard
+        """
+        if QGuiApplication.instance() is None:
+            return None
+        clipboard = QGuiApplication.clipboard()
+
+        def on_changed():
+            callback(clipboard.text())
+
+        clipboard.dataChanged.connect(on_changed)
+        return lambda: clipboard.dataChanged.disconnect(on_changed)
+
+    def copy_binary(self):
+        """ Return image in clipboard as BinaryClip or None if there is none.
+            Copies from office apps and browsers often carry a rendered
+            image next to their text, which is preferred then. Images larger
+            than MAX_IMAGE_DIMENSION are downscaled and ones still larger
+            than MAX_IMAGE_SIZE as PNG are encoded as JPEG
+        """
+        clipboard = QGuiApplication.clipboard()
+        mime_data = clipboard.mimeData()
+        if not mime_data or not mime_data.hasImage() or mime_data.hasText():
+            return None
+        image = clipboard.image()
+        if image.isNull():
+            return None
+        if max(image.width(), image.height()) > Config.MAX_IMAGE_DIMENSION:
+            image = image.scaled(
+                Config.MAX_IMAGE_DIMENSION,
+                Config.MAX_IMAGE_DIMENSION,
+                Qt.KeepAspectRatio,
+                Qt.SmoothTransformation,
+            )
+        data = self.encode_image(image, "PNG")
+        if len(data) <= Config.MAX_IMAGE_SIZE:
+            return BinaryClip(data, "image/png")
+        log.debug(f"Image has {len(data)} bytes as PNG, using JPEG")
+        data = self.encode_image(image, "JPEG", Config.IMAGE_JPEG_QUALITY)
+        return BinaryClip(data, "image/jpeg")
+
+    def paste_binary(self, clip):
+        """ Copy binary clip to the clipboard. Images are set as image, so
+            that any application can paste them
+        """
+        clipboard = QGuiApplication.clipboard()
+        if clip.is_image():
+            image = QImage.fromData(clip.data)
+            if not image.isNull():
+                clipboard.setImage(image)
+                return
+        mime_data = QMimeData()
+        mime_data.setData(clip.mime, QByteArray(clip.data))
+        clipboard.setMimeData(mime_data)
+
+    def paste_clip(self, clip):
+        """ Copy text or binary clip to the clipboard
+        """
+        if isinstance(clip, BinaryClip):
+            self.paste_binary(clip)
+        else:
+            lazy_import("api").Api.paste(clip)
+
     def is_valid_server_address(self, server):
         """ Does server address match the format?
         """
@@ -168,14 +388,14 @@ class Gui:
             if self.is_cred_input_valid(values):
                 server, user, pw = self.is_cred_input_valid(values)
                 if event == "Login":
-                    if self.check_cred_login_and_save(server, user, pw):
+                    if self.check_cred_login_and_save(window, server, user, pw):
                         sg.popup(
                             f"Credentials saved to config file: {Config.PATH_CONFIG_FILE}",
                             title=f"{Config.APP_NAME}",
                         )
                         return True
                 elif event == "Register":
-                    if self.check_cred_register_and_save(server, user, pw):
+                    if self.check_cred_register_and_save(window, server, user, pw):
                         sg.popup(
                             f"Credentials saved to config file: {Config.PATH_CONFIG_FILE}",
                             title=f"{Config.APP_NAME}",
@@ -183,6 +403,35 @@ class Gui:
                     return True
         return False
 
+    def run_in_background(self, window, function, *args):
+        """ Run function in a background thread while keeping window
+            responsive. Events occuring meanwhile are discarded
+
+        Returns:
+            Result of function. Exceptions it raised are raised here
+        """
+        outcome = {}
+
+        def target():
+            try:
+                outcome["result"] = function(*args)
+            except Exception as e:
+                outcome["error"] = e
+
+        thread = threading.Thread(target=target, daemon=True)
+        thread.start()
+        while thread.is_alive():
+            window.read(timeout=Config.TRAY_POLL_INTERVAL)
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome.get("result")
+
+    def save_cred(self, window, server, user, pw):
+        """ Write credentials to config file, deriving their keys in the
+            background
+        """
+        self.run_in_background(window, Config.write_config, server, user, pw)
+
     def set_config_ignore_ssl_cert(self, ignore_cert):
         """ Set config option to ignore ssl certificate validty in requests
 
@@ -219,12 +468,13 @@ class Gui:
         log.debug(f"{server} - {user} - {pw}")
         return server, user, pw
 
-    def check_cred_login_and_save(self, server, user, pw):
+    def check_cred_login_and_save(self, window, server, user, pw):
         """ Can we login using credentials? If so, save to configfile
         """
+        api = lazy_import("api")
         try:
-            Api.login(server, user, pw)
-        except LoginException as e:
+            self.run_in_background(window, api.Api.login, server, user, pw)
+        except api.LoginException as e:
             log.error(f"Could not log in.\nPW: {pw}\nError: {e}")
             answer = sg.popup_yes_no(
                 f"Login failed\n\nServer: {server}\nUser: {user}\nPassword: {pw}\n\n"
@@ -234,22 +484,23 @@ class Gui:
             )
             if answer == "Yes":
                 log.debug("Still saving creds")
-                Config.write_config(server, user, pw)
+                self.save_cred(window, server, user, pw)
                 return True
             else:
                 log.debug("Retry to login")
                 return False
         else:
             log.debug("Logged in. Writing config")
-            Config.write_config(server, user, pw)
+            self.save_cred(window, server, user, pw)
             return True
 
-    def check_cred_register_and_save(self, server, user, pw):
+    def check_cred_register_and_save(self, window, server, user, pw):
         """ Can we register using credentials? If so, save to configfile
         """
+        api = lazy_import("api")
         try:
-            Api.register(server, user, pw)
-        except RegisterException as e:
+            self.run_in_background(window, api.Api.register, server, user, pw)
+        except api.RegisterException as e:
             log.error(f"Could not register.\nPW: {pw}\nError: {e}")
             answer = sg.popup_yes_no(
                 f"Registration failed\n\nServer: {server}\nUser: {user}\nPassword: {pw}\n\n"
@@ -259,12 +510,12 @@ class Gui:
             )
             if answer == "Yes":
                 log.debug("Still saving creds")
-                Config.write_config(server, user, pw)
+                self.save_cred(window, server, user, pw)
                 return True
             else:
                 log.debug("Retry to register")
                 return False
         else:
             log.debug("Registration OK. Writing config")
-            Config.write_config(server, user, pw)
+            self.save_cred(window, server, user, pw)
             return True
@@ -0,0 +1,152 @@
+import sys
+import logging
+from functools import partial
+from collections import deque
+
+try:
+    # for package import
+    from .config import Config
+    from .log_config import log, ch
+    from .crypt import BinaryClip
+    from .lazy import lazy_import
+    from . import ipc
+except ModuleNotFoundError:
+    # for direct call of clipster.py
+    from config import Config
+    from log_config import log, ch
+    from crypt import BinaryClip
+    from lazy import lazy_import
+    import ipc
+
+
+def read_clip(mime=None):
+    """ Read text, or binary data of given MIME type, from stdin
+    """
+    if mime:
+        return BinaryClip(sys.stdin.buffer.read(), mime)
+    return sys.stdin.read()
+
+
+def write_clips(clips, separator="\n"):
+    """ Write clips to stdout as they come. A single binary clip is written
+        as raw bytes
+    """
+    clips = iter(clips)
+    first = next(clips, None)
+    second = next(clips, None)
+    if second is None and isinstance(first, BinaryClip):
+        sys.stdout.buffer.write(first.data)
+        return
+    for clip in (first, second):
+        if clip is not None:
+            sys.stdout.write(f"{clip}{separator}")
+    for clip in clips:
+        sys.stdout.write(f"{clip}{separator}")
+
+
+EXIT_QUEUED = 3
+
+
+def share(api, clip):
+    """ Share clip in this process. Queued clips are only sent by the tray
+        process, so the notice says when that happens
+
+    Returns:
+        str: Notice if the clip was queued instead of shared, else None
+    """
+    try:
+        api.upload(clip)
+    except lazy_import("api").ClipQueued:
+        return (
+            f"Server unreachable, Clip queued ({api.outbox.depth} waiting). "
+            f"It will be shared once {Config.APP_NAME} runs in the tray"
+        )
+
+
+def get(api, all_clips=False, last=1):
+    """ Return last clip or last n clips, or yield all clips while they are
+        fetched and decrypted in this process
+    """
+    if all_clips:
+        return api.iter_download()
+    if last > 1:
+        return deque(api.iter_download(), maxlen=last)
+    return api.download_new()[-1:]
+
+
+def run_via_daemon(args, clip=None, output=write_clips):
+    """ Let the running tray process execute the command with its warm
+        connection pool and caches
+
+    Raises:
+        ipc.IpcUnavailable: No tray process is running
+
+    Returns:
+        str: Notice if a shared clip was queued, else None
+    """
+    if args.command == "share":
+        response = ipc.request("share", clip=ipc.encode_clip(clip))
+        return response.get("queued")
+    if args.command == "search":
+        response = ipc.request("search", query=" ".join(args.words))
+    else:
+        response = ipc.request("get", all=args.all, last=args.last)
+    output(ipc.decode_clip(clip) for clip in response["clips"])
+
+
+def run_in_process(args, clip=None, output=write_clips):
+    """ Execute the command in this process, with the stored config. Clips
+        are passed to output before the Api is closed
+
+    Returns:
+        str: Notice if a shared clip was queued, else None
+    """
+    if not Config.is_configfile_valid():
+        raise ValueError(
+            f"No valid config at {Config.PATH_CONFIG_FILE}. "
+            f"Run {Config.APP_NAME} once to enter your credentials."
+        )
+    api = lazy_import("api").Api(
+        Config.SERVER, Config.USER, Config.PW_HASH_LOGIN, Config.PW_HASH_MSG
+    )
+    try:
+        if args.command == "share":
+            return share(api, clip)
+        elif args.command == "search":
+            output(api.search(" ".join(args.words)))
+        else:
+            output(get(api, args.all, args.last))
+    finally:
+        api.close()
+
+
+def run(args):
+    """ Run command of headless CLI without loading the GUI. Requests are
+        sent to a running tray process if there is one
+
+    Returns:
+        int: Exit code, EXIT_QUEUED if a shared clip was only queued
+    """
+    ch.setLevel(logging.WARNING)
+    clip = None
+    if args.command == "share":
+        clip = read_clip(args.mime)
+        if not len(clip):
+            print("Nothing to share on stdin", file=sys.stderr)
+            return 1
+    separator = "\0" if getattr(args, "null", False) else "\n"
+    output = partial(write_clips, separator=separator)
+    try:
+        try:
+            notice = run_via_daemon(args, clip, output)
+        except ipc.IpcUnavailable:
+            log.debug("No running Clipster process, executing in process")
+            notice = run_in_process(args, clip, output)
+    except Exception as e:
+        log.debug(f"{args.command} failed: {e!r}")
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    if notice:
+        print(notice, file=sys.stderr)
+        return EXIT_QUEUED
+    return 0
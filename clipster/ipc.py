@@ -0,0 +1,203 @@
+import os
+import json
+import base64
+import socket
+import threading
+import socketserver
+from collections import deque
+
+try:
+    # for package import
+    from .config import Config
+    from .log_config import log
+    from .crypt import BinaryClip
+    from .lazy import lazy_import
+except ModuleNotFoundError:
+    # for direct call of clipster.py
+    from config import Config
+    from log_config import log
+    from crypt import BinaryClip
+    from lazy import lazy_import
+
+
+class IpcUnavailable(Exception):
+    """ No running Clipster process accepts IPC requests
+    """
+
+
+class IpcException(Exception):
+    """ Running Clipster process could not execute request
+    """
+
+
+def encode_clip(clip):
+    if isinstance(clip, BinaryClip):
+        return {"mime": clip.mime, "data": base64.b64encode(clip.data).decode()}
+    return {"text": clip}
+
+
+def decode_clip(clip):
+    if "mime" in clip:
+        return BinaryClip(base64.b64decode(clip["data"]), clip["mime"])
+    return clip["text"]
+
+
+class IpcHandler(socketserver.StreamRequestHandler):
+    """ Execute one JSON encoded request per connection with the warm Api
+        of the tray process
+    """
+
+    def handle(self):
+        with self.server.active:
+            self.server.requests += 1
+        try:
+            try:
+                request = json.loads(self.rfile.readline())
+                response = {"ok": True, **self.execute(request)}
+            except Exception as e:
+                log.debug(f"IPC request failed: {e!r}")
+                response = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(response).encode() + b"\n")
+        finally:
+            with self.server.active:
+                self.server.requests -= 1
+                self.server.active.notify_all()
+
+    def execute(self, request):
+        api = self.server.api
+        command = request.get("command")
+        log.debug(f"IPC request: {command}")
+        if command == "share":
+            try:
+                api.upload(decode_clip(request["clip"]))
+            except lazy_import("api").ClipQueued as e:
+                return {"queued": str(e)}
+            return {}
+        if command == "get":
+            if request.get("all"):
+                clips = api.iter_download()
+            elif request.get("last", 1) > 1:
+                clips = deque(api.iter_download(), maxlen=request["last"])
+            else:
+                clips = api.download_new()[-1:]
+            return {"clips": [encode_clip(clip) for clip in clips]}
+        if command == "search":
+            clips = api.search(request["query"])
+            return {"clips": [encode_clip(clip) for clip in clips]}
+        if command == "status":
+            return {
+                "server": api.SERVER,
+                "user": api.USER,
+                "auto_share": Config.AUTO_SHARE,
+                "auto_receive": Config.AUTO_RECEIVE,
+                "decrypt_memo": api.crypto.memo_stats(),
+                "outbox": api.outbox.depth if api.outbox else None,
+            }
+        raise IpcException(f"Unknown command: {command}")
+
+
+if hasattr(socketserver, "UnixStreamServer"):
+
+    class IpcServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        """ Local Unix domain socket endpoint of the tray process, so that
+            scripts reuse its connection pool, caches and derived keys
+        """
+
+        daemon_threads = True
+
+        def __init__(self, path, api):
+            self.api = api
+            self.path = str(path)
+            self.requests = 0
+            self.active = threading.Condition()
+            old_umask = os.umask(0o177)
+            try:
+                super().__init__(self.path, IpcHandler)
+            finally:
+                os.umask(old_umask)
+
+        def start(self):
+            thread = threading.Thread(target=self.serve_forever, daemon=True)
+            thread.start()
+            log.info(f"Listening for IPC requests on {self.path}")
+            return thread
+
+        def wait_idle(self, timeout=None):
+            """ Wait until no request is being handled
+
+            Returns:
+                bool: Whether the server is idle
+            """
+            with self.active:
+                return self.active.wait_for(lambda: not self.requests, timeout)
+
+        def close(self):
+            self.shutdown()
+            self.server_close()
+            if os.path.exists(self.path):
+                os.unlink(self.path)
+
+
+else:
+    IpcServer = None
+
+
+def start_server(api):
+    """ Start IPC endpoint unless unsupported or another process serves it
+
+    Returns:
+        IpcServer: Running server or None
+    """
+    if IpcServer is None:
+        log.debug("IPC needs Unix domain sockets, not available")
+        return None
+    path = Config.PATH_IPC_SOCKET
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        try:
+            request("status")
+        except IpcUnavailable:
+            path.unlink()
+        else:
+            log.info("Another Clipster process is serving IPC requests")
+            return None
+    try:
+        server = IpcServer(path, api)
+    except OSError as e:
+        log.error(f"Cannot start IPC endpoint: {e}")
+        return None
+    server.start()
+    return server
+
+
+def request(command, **kwargs):
+    """ Send request to running Clipster process
+
+    Raises:
+        IpcUnavailable: No process is listening
+        IpcException: Request failed in the process
+
+    Returns:
+        dict: Response of the process
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        raise IpcUnavailable("Unix domain sockets not available")
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(Config.IPC_TIMEOUT)
+        try:
+            sock.connect(str(Config.PATH_IPC_SOCKET))
+        except OSError as e:
+            raise IpcUnavailable(e)
+        message = {"command": command, **kwargs}
+        sock.sendall(json.dumps(message).encode() + b"\n")
+        with sock.makefile("rb") as response_file:
+            line = response_file.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise IpcUnavailable("No response")
+    response = json.loads(line)
+    if not response.pop("ok"):
+        raise IpcException(response.get("error"))
+    return response
@@ -0,0 +1,16 @@
+import importlib
+
+
+def lazy_import(name):
+    """ Import a clipster module on first use instead of at startup.
+        Works for package import and direct call of clipster.py
+
+    Args:
+        name (str): Module name without package, e.g. "api"
+
+    Returns:
+        module: Imported module
+    """
+    if __package__:
+        return importlib.import_module(f"{__package__}.{name}")
+    return importlib.import_module(name)
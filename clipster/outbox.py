@@ -0,0 +1,126 @@
+import time
+import sqlite3
+import hashlib
+import threading
+
+try:
+    # for package import
+    from .log_config import log
+except ModuleNotFoundError:
+    # for direct call of clipster.py
+    from log_config import log
+
+
+class Outbox:
+    """ Persistent queue of encrypted clips that could not be shared yet.
+        Entries are committed before an upload is reported as queued, so
+        they survive crashes, and are sent oldest first
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            fingerprint TEXT NOT NULL,
+            text TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS outbox_fingerprint ON outbox (fingerprint, id);
+    """
+
+    def __init__(self, path, server, user, hash_msg, max_clips):
+        """ Open outbox. Only entries queued for the same server, user and
+            key are visible, others are kept until those are used again
+
+        Args:
+            path (pathlib.Path): Database file
+            server (str): Server the clips are shared with
+            user (str): User the clips are shared as
+            hash_msg (str): PW Hash for crypto the clips are encrypted with
+            max_clips (int): Maximum number of queued clips, oldest are dropped
+        """
+        self.max_clips = max_clips
+        self.fingerprint = self.get_fingerprint(server, user, hash_msg)
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.executescript(self.SCHEMA)
+            self.depth = self.count()
+        if self.depth:
+            log.info(f"{self.depth} clips waiting in outbox")
+            self.changed.set()
+
+    @staticmethod
+    def get_fingerprint(server, user, hash_msg):
+        """ Identify server, user and crypto key without storing the key
+        """
+        return hashlib.sha256(f"{server}|{user}|{hash_msg}".encode()).hexdigest()
+
+    def count(self):
+        """ Number of queued clips. Must be called holding the lock
+        """
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM outbox WHERE fingerprint = ?", (self.fingerprint,)
+        ).fetchone()[0]
+
+    def add(self, text):
+        """ Queue encrypted clip text (str) and wake up the sender
+        """
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO outbox (fingerprint, text, created_at) VALUES (?, ?, ?)",
+                (self.fingerprint, text, time.time()),
+            )
+            dropped = self.conn.execute(
+                "DELETE FROM outbox WHERE fingerprint = ? AND id NOT IN "
+                "(SELECT id FROM outbox WHERE fingerprint = ? ORDER BY id DESC "
+                "LIMIT ?)",
+                (self.fingerprint, self.fingerprint, self.max_clips),
+            ).rowcount
+            self.depth = self.count()
+        if dropped:
+            log.warning(f"Outbox full, dropped {dropped} oldest clips")
+        self.changed.set()
+
+    def peek(self, limit):
+        """ Return the oldest queued clips without removing them. Entries
+            queued as bytes by older versions are returned as text
+
+        Returns:
+            List: Tuples of entry id and encrypted clip text
+        """
+        with self.lock:
+            entries = self.conn.execute(
+                "SELECT id, text FROM outbox WHERE fingerprint = ? "
+                "ORDER BY id LIMIT ?",
+                (self.fingerprint, limit),
+            ).fetchall()
+        return [
+            (entry_id, text.decode() if isinstance(text, bytes) else text)
+            for entry_id, text in entries
+        ]
+
+    def remove(self, entry_ids):
+        """ Delete sent or rejected entries
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM outbox WHERE id = ?",
+                [(entry_id,) for entry_id in entry_ids],
+            )
+            self.depth = self.count()
+
+    def record_attempt(self, entry_ids):
+        """ Count a failed attempt to send entries
+        """
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "UPDATE outbox SET attempts = attempts + 1 WHERE id = ?",
+                [(entry_id,) for entry_id in entry_ids],
+            )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,120 @@
+import time
+import random
+import threading
+import requests
+
+try:
+    # for package import
+    from .config import Config
+    from .log_config import log
+    from .api import ApiException
+except ModuleNotFoundError:
+    # for direct call of clipster.py
+    from config import Config
+    from log_config import log
+    from api import ApiException
+
+
+class EventsNotSupported(Exception):
+    """ Server does not offer an event stream
+    """
+
+
+class ClipReceiver(threading.Thread):
+    """ Receive clips shared by other devices in background and paste them
+        on arrival. Listens to the server event stream if available, else
+        long-polls the clip list, which degrades to plain polling on servers
+        that answer immediately. Reconnects with jittered exponential backoff
+    """
+
+    ACTION = "Receive Clip"
+
+    def __init__(self, api, worker):
+        super().__init__(daemon=True)
+        self.api = api
+        self.worker = worker
+        self.stop_event = threading.Event()
+        self.use_events = True
+        self.failures = 0
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        log.info("Receiving clips in background")
+        while not self.stop_event.is_set():
+            try:
+                if self.use_events:
+                    self.listen_events()
+                else:
+                    self.long_poll()
+            except EventsNotSupported:
+                log.info("SERVER has no event stream, using long polling")
+                self.use_events = False
+            except (ApiException, requests.exceptions.RequestException) as e:
+                self.failures += 1
+                delay = self.get_backoff()
+                log.debug(f"Receive failed ({e}), reconnecting in {delay:.1f}s")
+                self.stop_event.wait(delay)
+            except Exception:
+                self.failures += 1
+                delay = self.get_backoff()
+                log.exception(f"Error receiving clips, retrying in {delay:.1f}s")
+                self.stop_event.wait(delay)
+            else:
+                self.failures = 0
+
+    def get_backoff(self):
+        """ Full jitter exponential backoff based on consecutive failures
+        """
+        delay = min(
+            Config.RECONNECT_BACKOFF_MAX,
+            Config.RECONNECT_BACKOFF_MIN * 2 ** (self.failures - 1),
+        )
+        return random.uniform(Config.RECONNECT_BACKOFF_MIN, delay)
+
+    def receive(self, wait=0):
+        """ Fetch and paste new clips and report them to the tray
+        """
+        clips = self.api.receive(wait)
+        if clips and not self.stop_event.is_set():
+            self.worker.put_result(self.ACTION, clips)
+        return clips
+
+    def long_poll(self):
+        """ Wait for new clips on server. If the server does not hold the
+            request, poll every RECEIVE_POLL_INTERVAL seconds instead
+        """
+        started = time.monotonic()
+        clips = self.receive(Config.LONG_POLL_WAIT)
+        if not clips and time.monotonic() - started < Config.LONG_POLL_WAIT / 2:
+            self.stop_event.wait(Config.RECEIVE_POLL_INTERVAL)
+
+    def listen_events(self):
+        """ Keep event stream open and fetch new clips for every event
+        """
+        self.receive()
+        res = self.api.request(
+            "GET",
+            self.api.SERVER + Config.API_EVENTS,
+            auth=(self.api.USER, self.api.HASH_LOGIN),
+            headers={"Accept": "text/event-stream"},
+            stream=True,
+            timeout=(Config.CONN_TIMEOUT, Config.EVENTS_READ_TIMEOUT),
+        )
+        with res:
+            if res.status_code in (404, 405, 406, 501):
+                raise EventsNotSupported()
+            if res.status_code != 200:
+                raise ApiException(res.text[0 : Config.MAX_RESPONSE_LEN])
+            if "text/event-stream" not in res.headers.get("Content-Type", ""):
+                raise EventsNotSupported()
+            self.failures = 0
+            # events are a few bytes each, larger reads would wait until
+            # several of them arrived
+            for line in res.iter_lines(chunk_size=1, decode_unicode=True):
+                if self.stop_event.is_set():
+                    return
+                if line and line.startswith("data:"):
+                    self.receive()
+        raise ApiException("Event stream closed")
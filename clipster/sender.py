@@ -0,0 +1,102 @@
+import random
+import threading
+
+try:
+    # for package import
+    from .config import Config
+    from .log_config import log
+    from .api import ApiException, ClipRejected
+except ModuleNotFoundError:
+    # for direct call of clipster.py
+    from config import Config
+    from log_config import log
+    from api import ApiException, ClipRejected
+
+
+class OutboxSender(threading.Thread):
+    """ Share clips queued in the outbox in background, oldest first.
+        While SERVER is unreachable, retries with jittered exponential backoff
+    """
+
+    ACTION = "Share queued Clips"
+
+    def __init__(self, api, worker):
+        super().__init__(daemon=True)
+        self.api = api
+        self.worker = worker
+        self.outbox = api.outbox
+        self.stop_event = threading.Event()
+        self.failures = 0
+
+    def stop(self):
+        self.stop_event.set()
+        self.outbox.changed.set()
+
+    def run(self):
+        log.info("Sending queued clips in background")
+        while not self.stop_event.is_set():
+            self.outbox.changed.wait(Config.OUTBOX_CHECK_INTERVAL)
+            self.outbox.changed.clear()
+            while self.outbox.depth and not self.stop_event.is_set():
+                try:
+                    sent, rejected = self.drain()
+                except ApiException as e:
+                    self.failures += 1
+                    delay = self.get_backoff()
+                    log.debug(f"Outbox not sent ({e}), retrying in {delay:.1f}s")
+                    self.stop_event.wait(delay)
+                    continue
+                except Exception:
+                    self.failures += 1
+                    delay = self.get_backoff()
+                    log.exception(f"Error sending outbox, retrying in {delay:.1f}s")
+                    self.stop_event.wait(delay)
+                    continue
+                self.failures = 0
+                if not self.stop_event.is_set():
+                    self.worker.put_result(self.ACTION, (sent, rejected))
+
+    def get_backoff(self):
+        """ Full jitter exponential backoff based on consecutive failures
+        """
+        delay = min(
+            Config.RECONNECT_BACKOFF_MAX,
+            Config.RECONNECT_BACKOFF_MIN * 2 ** (self.failures - 1),
+        )
+        return random.uniform(Config.RECONNECT_BACKOFF_MIN, delay)
+
+    def drain(self):
+        """ Send up to OUTBOX_BATCH_SIZE queued clips in order, in as few
+            requests as SERVER allows. Clips refused by SERVER are dropped,
+            as retrying them would block the queue. Clips that could not be
+            sent for any other reason stay queued
+
+        Raises:
+            ApiException: No clip was sent, they stay queued
+
+        Returns:
+            tuple: Number of sent and of rejected clips
+        """
+        entries = self.outbox.peek(Config.OUTBOX_BATCH_SIZE)
+        results = self.api.send_clips([text for _, text in entries])
+        done, waiting = [], []
+        sent = rejected = 0
+        failure = None
+        for (entry_id, _), error in zip(entries, results):
+            if error and not isinstance(error, ClipRejected):
+                failure = error
+                waiting.append(entry_id)
+                continue
+            if error:
+                log.error(f"SERVER rejected queued clip, dropping it: {error}")
+                rejected += 1
+            else:
+                sent += 1
+            done.append(entry_id)
+        self.outbox.remove(done)
+        if failure:
+            self.outbox.record_attempt(waiting)
+            if not done:
+                raise failure
+        log.info(f"Shared {sent} queued clips, {self.outbox.depth} waiting")
+        return sent, rejected
@@ -0,0 +1,84 @@
+import json
+import codecs
+
+WHITESPACE = " \t\n\r"
+
+
+def iter_decoded(chunks, encoding=None):
+    """ Decode byte chunks incrementally, so multi-byte characters may
+        be split between chunks
+    """
+    decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def iter_json_array(chunks):
+    """ Parse a top level JSON array of objects from text chunks and yield
+        each object as soon as it is complete. Only the current object is
+        held in memory, not the whole document
+
+    Args:
+        chunks (iterable): Text chunks of the JSON document
+
+    Raises:
+        ValueError: Document is not a JSON array of objects
+
+    Yields:
+        dict: Parsed array items
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    started = False
+    expect_item = True
+    for chunk in chunks:
+        buffer += chunk
+        if started and "}" not in chunk and "]" not in chunk:
+            continue
+        pos = 0
+        while True:
+            while pos < len(buffer) and buffer[pos] in WHITESPACE:
+                pos += 1
+            if pos == len(buffer):
+                break
+            char = buffer[pos]
+            if not started:
+                if char != "[":
+                    raise ValueError(f"Expected JSON array, got {char!r}")
+                started = True
+                pos += 1
+            elif char == "]":
+                return
+            elif char == "," and not expect_item:
+                expect_item = True
+                pos += 1
+            elif char == "{" and expect_item:
+                try:
+                    item, pos = decoder.raw_decode(buffer, pos)
+                except json.JSONDecodeError:
+                    break
+                expect_item = False
+                yield item
+            else:
+                raise ValueError(f"Unexpected {char!r} in JSON array")
+        buffer = buffer[pos:]
+    raise ValueError("Incomplete JSON array")
+
+
+def iter_batches(items, size):
+    """ Group items into lists of up to size items, so they can be
+        processed together without materializing all of them
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,137 @@
+import time
+import threading
+from concurrent.futures import wait
+
+try:
+    # for package import
+    from .config import Config
+    from .log_config import log
+except ModuleNotFoundError:
+    # for direct call of clipster.py
+    from config import Config
+    from log_config import log
+
+
+class ClipboardWatcher(threading.Thread):
+    """ Watch the local clipboard and share changed clips automatically.
+        If the GUI notifies about clipboard changes, the clipboard is only
+        checked after a change. Else it is polled, fast after recent changes
+        and backing off while idle
+    """
+
+    ACTION = "Auto-share Clip"
+
+    def __init__(self, api, worker, watch_clipboard=None):
+        """
+        Args:
+            api (Api): Api to share clips with
+            worker (Worker): Runs uploads
+            watch_clipboard (callable): Registers a callback for clipboard
+                changes and returns a function to unregister it, or None if
+                changes cannot be watched
+        """
+        super().__init__(daemon=True)
+        self.api = api
+        self.worker = worker
+        self.stop_event = threading.Event()
+        self.changed = threading.Event()
+        self.interval = Config.WATCH_INTERVAL_MIN
+        self.seen_hash = None
+        self.seen_at = 0
+        self.shared_hash = None
+        self.shared_at = 0
+        self.clip = None
+        self.unwatch = None
+        if watch_clipboard:
+            self.unwatch = watch_clipboard(self.on_clipboard_changed)
+        if not self.unwatch:
+            log.debug("Clipboard changes are not notified, polling clipboard")
+
+    def content_hash(self, clip):
+        return self.api.crypto.content_hash(clip)
+
+    def stop(self):
+        if self.unwatch:
+            self.unwatch()
+        self.stop_event.set()
+        self.changed.set()
+
+    def on_clipboard_changed(self, clip):
+        """ Called on the GUI thread with the new clipboard text
+        """
+        self.clip = clip
+        self.changed.set()
+
+    def run(self):
+        log.info("Watching clipboard for auto-share")
+        self.seen_hash = self.shared_hash = self.read_clipboard_hash()
+        while not self.wait():
+            self.interval = self.poll()
+
+    def wait(self):
+        """ Wait until the clipboard should be checked again. When notified
+            about changes, the wait while idle lasts until the next change
+
+        Returns:
+            bool: Whether the watcher was stopped
+        """
+        if self.unwatch and self.interval > Config.WATCH_INTERVAL_MIN:
+            self.changed.wait()
+            self.changed.clear()
+        else:
+            self.stop_event.wait(self.interval)
+        return self.stop_event.is_set()
+
+    def copy(self):
+        """ Return clipboard text, as last notified by the GUI if possible
+        """
+        if self.unwatch:
+            return self.clip
+        return self.api.copy()
+
+    def read_clipboard_hash(self):
+        try:
+            clip = self.copy()
+        except Exception as e:
+            log.debug(f"Cannot read clipboard: {e}")
+            return self.seen_hash
+        if not clip or not clip.strip():
+            return self.seen_hash
+        return self.content_hash(clip)
+
+    def poll(self):
+        """ Check clipboard once and share it if it changed and settled
+
+        Returns:
+            float: Seconds to wait until next poll
+        """
+        now = time.monotonic()
+        clip_hash = self.read_clipboard_hash()
+        if clip_hash != self.seen_hash:
+            self.seen_hash = clip_hash
+            self.seen_at = now
+            return Config.WATCH_INTERVAL_MIN
+        if clip_hash == self.shared_hash or self.is_received(clip_hash):
+            self.shared_hash = clip_hash
+            return min(self.interval * 2, Config.WATCH_INTERVAL_MAX)
+        if now - self.seen_at < Config.WATCH_DEBOUNCE:
+            return Config.WATCH_INTERVAL_MIN
+        if now - self.shared_at < Config.AUTO_SHARE_MIN_INTERVAL:
+            return Config.WATCH_INTERVAL_MIN
+        self.share()
+        return Config.WATCH_INTERVAL_MIN
+
+    def is_received(self, clip_hash):
+        """ Was clip pasted by us after downloading it from server?
+        """
+        received = self.api.last_pasted
+        return received is not None and self.content_hash(received) == clip_hash
+
+    def share(self):
+        """ Upload current clipboard and wait for the upload to finish.
+            Failed clips are not retried
+        """
+        self.shared_at = time.monotonic()
+        clip = self.copy()
+        self.shared_hash = self.content_hash(clip)
+        wait([self.worker.submit(self.ACTION, self.api.upload, clip)])
@@ -0,0 +1,104 @@
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+try:
+    # for package import
+    from .log_config import log
+except ModuleNotFoundError:
+    # for direct call of clipster.py
+    from log_config import log
+
+
+class Worker:
+    """ Run network and crypto tasks in background threads and hand their
+        results back to the tray loop, which polls them with get_results
+    """
+
+    def __init__(self, max_workers):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.results = queue.Queue()
+        self.pending = {}
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def submit(self, action, fn, *args, coalesce=False, **kwargs):
+        """ Run fn in background. With coalesce, while a task for the same
+            action is still pending, it is returned instead of starting
+            another one. Only use it for actions whose result does not depend
+            on when they are started, e.g. downloads, never for shares
+
+        Args:
+            action (str): Name of action, e.g. the tray menu entry
+            fn (callable): Function to run
+            coalesce (bool): Reuse pending task of the same action
+
+        Returns:
+            concurrent.futures.Future: Future of the task
+        """
+        with self.lock:
+            key = action if coalesce else object()
+            future = self.pending.get(key)
+            if future and not future.done():
+                log.debug(f"Coalescing {action} with pending request")
+                return future
+            generation = self.generation
+            future = self.executor.submit(fn, *args, **kwargs)
+            self.pending[key] = future
+        future.add_done_callback(
+            lambda future: self._task_done(key, action, generation, future)
+        )
+        return future
+
+    def _task_done(self, key, action, generation, future):
+        with self.lock:
+            if self.pending.get(key) is future:
+                del self.pending[key]
+        if future.cancelled():
+            log.debug(f"{action} was cancelled")
+            return
+        if future.exception():
+            log.error(f"{action} failed: {future.exception()!r}")
+        self.results.put((action, generation, future))
+
+    def put_result(self, action, result):
+        """ Hand result of an action that ran in another thread to the tray
+        """
+        future = Future()
+        future.set_result(result)
+        self.results.put((action, self.generation, future))
+
+    def cancel_all(self):
+        """ Cancel queued tasks and discard results of running ones, e.g.
+            because they were started with an outdated configuration
+
+        Returns:
+            List: Futures of tasks that were already running
+        """
+        with self.lock:
+            self.generation += 1
+            running = [
+                future for future in self.pending.values() if not future.cancel()
+            ]
+            self.pending.clear()
+        return running
+
+    def get_results(self):
+        """ Yield action and future of finished, non stale tasks without
+            blocking
+        """
+        while True:
+            try:
+                action, generation, future = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if generation != self.generation:
+                log.debug(f"Dropping stale result of {action}")
+                continue
+            yield action, future
+
+    def shutdown(self):
+        """ Cancel pending tasks and stop accepting new ones
+        """
+        self.cancel_all()
+        self.executor.shutdown(wait=False)